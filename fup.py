@@ -17,36 +17,74 @@ from __future__ import print_function, absolute_import
 
 import os
 import sys
+import errno
 import time
-import signal
 import base64
-import gzip
+import binascii
 import codecs
 import re
+import select
+import shutil
 import socket
+import struct
 
 from textwrap import dedent
+from io import BytesIO
 from ntpath import basename as ntbasename
 from posixpath import basename as posixbasename
-from threading import Thread
+from threading import Thread, Lock, Semaphore, Condition, Event
+from collections import deque
 
 from cgi import FieldStorage
 from wsgiref.simple_server import (
-    make_server,
     software_version,
-    WSGIRequestHandler
+    ServerHandler,
+    WSGIRequestHandler,
+    WSGIServer
 )
 
+try:
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from SocketServer import ThreadingMixIn
+
+# Modules used only by some of code paths (sproxy, command-line client,
+# post-processing, tar ingestion, ...) are imported where they're needed,
+# to keep import (and thus worker startup) time down. Those imported above
+# are loaded by cgi/wsgiref anyway.
+
 __all__ = [
+    "Admission",
     "app",
     "Application",
+    "Client",
+    "Delta",
     "FUPFieldStorage",
     "FUPRequestHandler",
+    "FUPServer",
+    "FUPServerHandler",
     "GzipGlue",
+    "Index",
     "Main",
+    "NullStats",
+    "NullTimer",
+    "PostProcessor",
+    "Profiler",
+    "Replicator",
+    "RequestBody",
+    "ShapedStream",
+    "Shaper",
+    "SlowClient",
+    "SpoolFile",
+    "Storage",
+    "StageTimer",
+    "Stats",
     "Template",
+    "TimedStream",
+    "TokenBucket",
     "utf8_encode",
-    "View"
+    "View",
+    "Watchdog"
 ]
 
 __author__ = "drmats"
@@ -72,8 +110,39 @@ except ImportError:
 
 
 
+# python 2/3 unicode issues:
+# Using "from __future__ import unicode_literals" statement in python 2.x
+# is causing all string literals to be actually of type <type "unicode">
+# therefore they should be encoded in all places which require type
+# <type "str"> (e.g. "start_response" callback). But in python 3.x that
+# approach results in type <class "bytes"> therefore TypeError is thrown.
+# Unfortunately u"..." syntax is forbidden in python <3.3.x.
+# So it's better to leave string literals with their default type behaviour
+# in python 2.x/3.x but just handle the encoding. Python 2 defines "unicode"
+# function for converting <type "str"> to <type "unicode"> which then behaves
+# correctly while encoding back to "utf-8". Thus two definitions of
+# utf8_encode function below.
+if hasattr(__builtins__, "unicode"):
+    def utf8_encode (s, e="strict"):
+        """Python 2.x utf-8 encoder."""
+        # pylint:disable=undefined-variable
+        return unicode(s, "utf-8").encode("utf-8", e)  # noqa
+else:
+    def utf8_encode (s, e="strict"):
+        """Python 3.x utf-8 encoder."""
+        return s.encode("utf-8", errors=e)
+
+
+
+
+# python >=3.3 provides a high-resolution, monotonic performance counter
+clock = getattr(time, "perf_counter", time.time)
+
+
+
+
 # Python 3.2.x equivalent of gzip.compress and gzip.decompress
-# for python 2.x.
+# for python 2.x (gzip module is imported on first use).
 class GzipGlue(object):
 
     """Gzip glue compat. layer for compress/decompress functions."""
@@ -82,6 +151,11 @@ class GzipGlue(object):
     def _compress_p2 (s):
         """Emulates gzip.compress from python >=3.2."""
 
+        import gzip
+        try:
+            from StringIO import StringIO
+        except ImportError:
+            from io import StringIO
         osio = StringIO()
         try:
             if hasattr(gzip.GzipFile, "__exit__"):
@@ -100,6 +174,11 @@ class GzipGlue(object):
     def _decompress_p2 (s):
         """Emulates gzip.decompress from python >=3.2."""
 
+        import gzip
+        try:
+            from StringIO import StringIO
+        except ImportError:
+            from io import StringIO
         isio = StringIO(s)
         try:
             if hasattr(gzip.GzipFile, "__exit__"):
@@ -115,42 +194,407 @@ class GzipGlue(object):
             isio.close()
 
 
-# based on a simple "feature detection" assign compress/decompress methods
-if hasattr(gzip, "compress") and hasattr(gzip, "decompress"):
-    GzipGlue.compress = staticmethod(gzip.compress)
-    GzipGlue.decompress = staticmethod(gzip.decompress)
-else:
-    try:
-        from StringIO import StringIO
-    except ImportError:
-        from io import StringIO
-    GzipGlue.compress = staticmethod(GzipGlue._compress_p2)
-    GzipGlue.decompress = staticmethod(GzipGlue._decompress_p2)
+    # based on a simple "feature detection" use gzip's own functions
+    @staticmethod
+    def compress (s):
+        """Gzip-compress a string."""
 
+        import gzip
+        if hasattr(gzip, "compress"):
+            return gzip.compress(s)
+        return GzipGlue._compress_p2(s)
 
 
+    @staticmethod
+    def decompress (s):
+        """Decompress gzip-compressed string."""
 
-# python 2/3 unicode issues:
-# Using "from __future__ import unicode_literals" statement in python 2.x
-# is causing all string literals to be actually of type <type "unicode">
-# therefore they should be encoded in all places which require type
-# <type "str"> (e.g. "start_response" callback). But in python 3.x that
-# approach results in type <class "bytes"> therefore TypeError is thrown.
-# Unfortunately u"..." syntax is forbidden in python <3.3.x.
-# So it's better to leave string literals with their default type behaviour
-# in python 2.x/3.x but just handle the encoding. Python 2 defines "unicode"
-# function for converting <type "str"> to <type "unicode"> which then behaves
-# correctly while encoding back to "utf-8". Thus two definitions of
-# utf8_encode function below.
-if hasattr(__builtins__, "unicode"):
-    def utf8_encode (s, e="strict"):
-        """Python 2.x utf-8 encoder."""
-        # pylint:disable=undefined-variable
-        return unicode(s, "utf-8").encode("utf-8", e)  # noqa
-else:
-    def utf8_encode (s, e="strict"):
-        """Python 3.x utf-8 encoder."""
-        return s.encode("utf-8", errors=e)
+        import gzip
+        if hasattr(gzip, "decompress"):
+            return gzip.decompress(s)
+        return GzipGlue._decompress_p2(s)
+
+
+
+
+# "64K", "10M", "1.5G", ... -> number of bytes
+def byte_size (s):
+    """Parse human-readable amount of bytes."""
+
+    units = {"K" : 1<<10, "M" : 1<<20, "G" : 1<<30}
+    s = s.strip().upper().rstrip("B")
+    if s and s[-1] in units:
+        return int(float(s[:-1]) * units[s[-1]])
+    return int(s)
+
+
+
+
+# Lightweight per-request stopwatch used to break request
+# handling time down into named stages (read, parse, write, ...).
+class StageTimer(object):
+
+    """Exclusive-time accumulator of (possibly nested) named stages."""
+
+    def __init__ (self):
+        """Initialize an empty stage registry."""
+
+        self.order = []
+        self.durations = {}
+        self.running = []
+
+
+    def start (self, name):
+        """Enter a stage."""
+
+        self.running.append([name, clock(), 0.0])
+
+
+    def stop (self):
+        """Leave the innermost stage and account its exclusive time."""
+
+        name, started, nested = self.running.pop()
+        elapsed = clock() - started
+        if name not in self.durations:
+            self.order.append(name)
+            self.durations[name] = 0.0
+        self.durations[name] += elapsed - nested
+        if self.running:
+            self.running[-1][2] += elapsed
+
+
+    def stage (self, name):
+        """Enter a stage and return self (to be used in a "with" block)."""
+
+        self.start(name)
+        return self
+
+
+    def __enter__ (self):
+        return self
+
+
+    def __exit__ (self, *exc_info):
+        self.stop()
+
+
+    def header (self):
+        """Value of the Server-Timing header (durations in milliseconds)."""
+
+        return ", ".join(
+            "%s;dur=%.3f" % (name, self.durations[name] * 1000)
+            for name in self.order
+        )
+
+
+
+
+# Used when timing is disabled, so the code paths stay the same.
+class NullTimer(StageTimer):
+
+    """Stage timer which doesn't measure anything."""
+
+    def start (self, name):
+        pass
+
+
+    def stop (self):
+        pass
+
+
+
+
+# File-like object wrapper accounting time spent in read/write calls
+# (e.g. on "wsgi.input" or an upload file) to a given timer stage.
+class TimedStream(object):
+
+    """Stream proxy measuring read/readline/write calls."""
+
+    def __init__ (self, stream, timer, name):
+        """Wrap stream, account its I/O to a timer stage of a given name."""
+
+        self.stream = stream
+        self.timer = timer
+        self.name = name
+
+
+    def read (self, *args):
+        self.timer.start(self.name)
+        try:
+            return self.stream.read(*args)
+        finally:
+            self.timer.stop()
+
+
+    def readline (self, *args):
+        self.timer.start(self.name)
+        try:
+            return self.stream.readline(*args)
+        finally:
+            self.timer.stop()
+
+
+    def write (self, data):
+        self.timer.start(self.name)
+        try:
+            return self.stream.write(data)
+        finally:
+            self.timer.stop()
+
+
+    def __getattr__ (self, name):
+        return getattr(self.stream, name)
+
+
+
+
+# Run one request in N under cProfile (and tracemalloc, if available)
+# and dump collected statistics into a directory for later analysis
+# (e.g. with "python -m pstats" or tracemalloc.Snapshot.load).
+class Profiler(object):
+
+    """Sampling request profiler."""
+
+    def __init__ (self, every, directory):
+        """Sample each "every"-th request, put dumps in "directory"."""
+
+        self.every = every
+        self.directory = directory
+        self.count = 0
+        self.lock = Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+
+    def run (self, fun, env):
+        """Call fun(env), profile the call if it's the sampled one."""
+
+        self.count += 1
+        # only one request at a time can be profiled
+        if self.count % self.every or not self.lock.acquire(False):
+            return fun(env)
+
+        import cProfile
+        try:
+            import tracemalloc
+        except ImportError:
+            tracemalloc = None
+
+        base = os.path.join(self.directory, "%s-%u-%u" % (
+            time.strftime("%Y%m%d%H%M%S"), os.getpid(), self.count
+        ))
+        tracing = tracemalloc is not None and not tracemalloc.is_tracing()
+        try:
+            if tracing:
+                tracemalloc.start()
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(fun, env)
+            finally:
+                profile.dump_stats(base + ".prof")
+                if tracing:
+                    tracemalloc.take_snapshot().dump(base + ".tracemalloc")
+                    tracemalloc.stop()
+                print(
+                    "%s - - [%s] profile: \"%s\" dumped" % (
+                        env.get("REMOTE_ADDR", "-"),
+                        time.strftime("%d/%b/%Y %H:%M:%S"),
+                        base
+                    ),
+                    file=sys.stderr
+                )
+        finally:
+            self.lock.release()
+
+
+
+
+# Thread-safe token bucket. Tokens are bytes, the caller takes them
+# up front (the bucket can go into debt) and is told how long to wait,
+# so concurrent consumers are served in the order of their requests.
+class TokenBucket(object):
+
+    """Rate limiter."""
+
+    def __init__ (self, rate, burst=None):
+        """Allow "rate" bytes/s on average and "burst" bytes at once."""
+
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.stamp = clock()
+        self.lock = Lock()
+
+
+    def reserve (self, amount):
+        """Take "amount" of tokens, return delay (in seconds) to respect."""
+
+        with self.lock:
+            now = clock()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.stamp) * self.rate
+            )
+            self.stamp = now
+            self.tokens -= amount
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+
+
+# Bandwidth shaping of request bodies. Every upload takes tokens from its
+# client's (IP address) bucket, its user's bucket and from the global one.
+# Reads are split into small quanta and each one waits in line for its
+# tokens. Global tokens are taken in turns of clients (users when known):
+# while one upload of a client waits for its tokens, the other ones of the
+# same client wait for it, so clients (not uploads) share global bandwidth
+# fairly in a round-robin fashion.
+class Shaper(object):
+
+    """Per-client, per-user and global upload rate limits."""
+
+    # maximum amount of data read at once
+    quantum = 1<<14
+
+
+    def __init__ (self, client_rate=0, user_rate=0, total_rate=0):
+        """Set limits in bytes/s (0 - unlimited)."""
+
+        self.rates = {"client" : client_rate, "user" : user_rate}
+        self.total = TokenBucket(total_rate) if total_rate else None
+        self.buckets = {}
+        self.lock = Lock()
+
+
+    def acquire (self, kind, key):
+        """Get (shared) bucket of a given client/user."""
+
+        with self.lock:
+            if (kind, key) not in self.buckets:
+                self.buckets[(kind, key)] = [
+                    [0.0] if kind == "turn" else
+                    TokenBucket(self.rates[kind]), 0
+                ]
+            entry = self.buckets[(kind, key)]
+            entry[1] += 1
+            return entry[0]
+
+
+    def release (self, kind, key):
+        """Forget bucket of a given client/user when it's no longer used."""
+
+        with self.lock:
+            entry = self.buckets[(kind, key)]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.buckets[(kind, key)]
+
+
+    def turn (self, until, amount):
+        """Take global tokens in a client's turn, return (delay, taken)."""
+
+        with self.lock:
+            now = clock()
+            if until[0] > now:
+                # another upload of the client is waiting for its tokens
+                return until[0] - now, False
+            delay = self.total.reserve(amount)
+            until[0] = now + delay
+            return delay, True
+
+
+    def stream (self, stream, client, user=None, timer=None):
+        """Wrap request body stream of a given client/user."""
+
+        keys = []
+        if self.rates["client"]:
+            keys.append(("client", client))
+        if self.rates["user"] and user is not None:
+            keys.append(("user", user))
+        buckets = [self.acquire(kind, key) for kind, key in keys]
+        until = None
+        if self.total is not None:
+            keys.append(("turn", client if user is None else user))
+            until = self.acquire(*keys[-1])
+        return ShapedStream(
+            stream, buckets, self.quantum,
+            lambda: [self.release(kind, key) for kind, key in keys],
+            timer, None if until is None else (
+                lambda amount: self.turn(until, amount)
+            )
+        )
+
+
+
+
+# Request body stream with reads throttled by a set of token buckets.
+class ShapedStream(object):
+
+    """Rate-limited input stream."""
+
+    def __init__ (
+        self, stream, buckets, quantum, release, timer=None, turn=None
+    ):
+        """Wrap stream, "release" is called when it's closed."""
+
+        self.stream = stream
+        self.buckets = buckets
+        self.quantum = quantum
+        self.release = release
+        self.timer = timer or NullTimer()
+        self.turn = turn
+
+
+    def throttle (self, data):
+        """Wait until transfer of data fits in all limits."""
+
+        if data:
+            start = clock()
+            delay = max([0.0] + [b.reserve(len(data)) for b in self.buckets])
+            if self.turn is not None:
+                wait, taken = self.turn(len(data))
+                while not taken:
+                    self.wait(wait)
+                    wait, taken = self.turn(len(data))
+                delay = max(delay - (clock() - start), wait)
+            self.wait(delay)
+        return data
+
+
+    def wait (self, delay):
+        """Sleep for "delay" seconds."""
+
+        if delay > 0:
+            if hasattr(self.stream, "pause"):
+                # not the client's fault (see --min-rate)
+                self.stream.pause(delay)
+            with self.timer.stage("throttle"):
+                time.sleep(delay)
+
+
+    def read (self, size=-1):
+        if size is None or size < 0:
+            return b"".join(iter(lambda: self.read(self.quantum), b""))
+        return self.throttle(self.stream.read(min(size, self.quantum)))
+
+
+    def readline (self, size=-1):
+        if size is None or size < 0 or size > self.quantum:
+            size = self.quantum
+        return self.throttle(self.stream.readline(size))
+
+
+    def readlines (self, hint=-1):
+        return list(iter(self.readline, b""))
+
+
+    def __iter__ (self):
+        return iter(self.readline, b"")
+
+
+    def close (self):
+        if self.release is not None:
+            self.release()
+            self.release = None
 
 
 
@@ -216,6 +660,15 @@ class Template(object):
             float: left;
         }
         .message { clear: both;  margin-left: 10px; }
+        .queue .entry { height: 30px; line-height: 30px; }
+        .queue .entry .name {
+            float: left;
+            margin-left: 10px;
+            max-width: 400px;
+            overflow: hidden;
+            white-space: nowrap;
+            text-overflow: ellipsis;
+        }
         a, a:visited { text-decoration: none; color: #0077CC; }
         a:hover { text-decoration: underline; }
         p { margin: 0px; padding: 0px; }"""
@@ -223,7 +676,7 @@ class Template(object):
 
 
     # gzipped and base64-encoded *.ico file
-    favicon = GzipGlue.decompress(base64.b64decode(utf8_encode(dedent("""\
+    favicon_gz = dedent("""\
         H4sIAIRbzFIC/41UPWsiYRCe1bBGRAg5OAJXRNLERgvLC3KNlhZ+4AciWohEsBA\
         VrJSrbHIHd7/B+hovpeARKzurNDb3F7xgdFWYzLPJbjZx5RwZeZl35nHeZ56RSJ\
         HPyQnJt4+uj4g+EpFfXEISeY7vM2Ymt9ttnI+bzebnUqnUTaVSd4VC4RGeTqfvi\
@@ -235,14 +688,23 @@ class Template(object):
         0fmwcg/HG6DT6XR66ff7bfkWfG40GrZ30Cm0nsvlHMLVDfg/VD/QKbSOfYEGx+P\
         xB5nFr0MwoFNoHfti3R9goI99b3npmaF17AtqsLfz+dzEwFvABzjFXDBb6AMag0\
         6hdeyLdfe3X4j+uoj+OIm+Ks9Ois0fhfJ6j1zUrM6JngCTkE5/fgQAAA=="""
-    ))))
+    )
+
+
+    @staticmethod
+    def favicon ():
+        """Decoded *.ico file."""
+
+        return GzipGlue.decompress(
+            base64.b64decode(utf8_encode(Template.favicon_gz))
+        )
 
 
     # client javascript
     client_logic = dedent("""\
         /*global
-            Date, document, File, FormData, Math,
-            XMLHttpRequest, XMLHttpRequestUpload, window
+            Array, Date, document, File, FormData, isNaN, Math, parseInt,
+            String, XMLHttpRequest, XMLHttpRequestUpload, window
         */
         /*jslint
             browser: true,
@@ -252,16 +714,46 @@ class Template(object):
         */
         (function (u) {
             "use strict";
-            u.onFsChange = function () { u.file = this.files.item(0); };
+            u.queue = [];
+            u.running = [];
+            u.active = 0;
+            u.waiting = 0;
+            u.holdUntil = 0;
+            u.maxRetries = 5;
+            u.reset = function () {
+                u.total = 0; u.done = 0; u.failed = [];
+                u.size = 0; u.finished = 0;
+                u.start = Date.now();
+            };
+            u.idle = function () {
+                return u.active === 0 && u.queue.length === 0 &&
+                    u.waiting === 0;
+            };
+            u.kB = function (b) {
+                return (Math.floor(b / 1024 * 100) / 100) + 'kB';
+            };
+            u.escape = function (s) {
+                return String(s)
+                    .replace(/&/g, '&amp;').replace(/</g, '&lt;')
+                    .replace(/>/g, '&gt;').replace(/"/g, '&quot;');
+            };
+            u.bar = function () {
+                return '<div class="progressBar">' +
+                        '<div class="progress"></div>' +
+                    '</div>' +
+                    '<div class="percentage">' +
+                        '[<span class="p">0</span>%]' +
+                    '</div>';
+            };
             u.replaceInput = function () {
                 var ni;
                 if (u.fs) {
-                    u.fs.removeEventListener('change', u.onFsChange, false);
                     ni = document.createElement('input');
                     [
                         ['type', 'file'],
                         ['name', 'file'],
-                        ['class', 'fselect']
+                        ['class', 'fselect'],
+                        ['multiple', 'multiple']
                     ].forEach(function (attr) {
                         ni.setAttribute(attr[0], attr[1]);
                     });
@@ -269,104 +761,241 @@ class Template(object):
                 } else {
                     ni = document.querySelector('.fselect');
                 }
-                ni.addEventListener('change', u.onFsChange, false);
                 u.fs = ni;
             };
+            u.enqueue = function (file) {
+                if (u.idle()) { u.reset(); }
+                u.queue.push({ file: file, attempt: 0, loaded: 0 });
+                u.total += 1;
+                u.size += file.size;
+            };
+            u.pump = function () {
+                var now = Date.now();
+                if (u.holdUntil > now) {
+                    // server asked to back off (Retry-After)
+                    if (!u.holdTimer) {
+                        u.holdTimer = window.setTimeout(function () {
+                            u.holdTimer = null;
+                            u.pump();
+                        }, u.holdUntil - now);
+                    }
+                } else {
+                    while (u.active < u.parallel && u.queue.length > 0) {
+                        u.send(u.queue.shift());
+                    }
+                }
+                u.render();
+            };
+            u.retryAfter = function (xhr) {
+                var v = xhr.getResponseHeader('Retry-After'), s;
+                if (!v) { return 0; }
+                s = parseInt(v, 10);
+                if (isNaN(s)) {
+                    // HTTP-date
+                    s = (Date.parse(v) - Date.now()) / 1000;
+                }
+                return isNaN(s) ? 0 : Math.max(0, s * 1000);
+            };
+            u.finish = function (entry) {
+                u.active -= 1;
+                u.running.splice(u.running.indexOf(entry), 1);
+                u.list.removeChild(entry.row);
+                entry.loaded = 0;
+            };
+            u.fail = function (entry, reason) {
+                u.failed.push(entry.file.name + ' (' + reason + ')');
+            };
+            u.retry = function (entry, reason) {
+                entry.attempt += 1;
+                if (entry.attempt > u.maxRetries) {
+                    u.fail(entry, reason);
+                    return;
+                }
+                u.waiting += 1;
+                window.setTimeout(function () {
+                    u.waiting -= 1;
+                    u.queue.unshift(entry);
+                    u.pump();
+                }, Math.min(
+                    30000, 1000 * Math.pow(2, entry.attempt - 1)
+                ) * (1 + Math.random() / 2));
+            };
+            u.send = function (entry) {
+                var xhr = new XMLHttpRequest(), fd = new FormData();
+                u.active += 1;
+                u.running.push(entry);
+                entry.row = document.createElement('div');
+                entry.row.className = 'entry';
+                entry.row.innerHTML = u.bar() +
+                    '<div class="name">' +
+                        u.escape(entry.file.name) +
+                    '</div>';
+                u.list.appendChild(entry.row);
+                entry.progress = entry.row.querySelector('.progress');
+                entry.p = entry.row.querySelector('.p');
+                fd.append('file', entry.file);
+                xhr.upload.addEventListener('progress', function (e) {
+                    var p;
+                    if (e.lengthComputable && e.total > 0) {
+                        p = Math.floor(e.loaded / e.total * 100);
+                        entry.loaded = entry.file.size * e.loaded / e.total;
+                        entry.progress.style.width = (2*p) + 'px';
+                        entry.p.innerHTML = p;
+                        u.render();
+                    }
+                }, false);
+                xhr.addEventListener('load', function () {
+                    u.finish(entry);
+                    if (xhr.status >= 200 && xhr.status < 300) {
+                        u.done += 1;
+                        u.finished += entry.file.size;
+                    } else if (
+                        (xhr.status === 503 || xhr.status === 429) &&
+                        u.retryAfter(xhr) > 0
+                    ) {
+                        // admission control - wait as long as asked to
+                        // (doesn't count as a failed attempt)
+                        u.holdUntil = Math.max(
+                            u.holdUntil, Date.now() + u.retryAfter(xhr)
+                        );
+                        u.queue.unshift(entry);
+                    } else if (
+                        xhr.status >= 500 ||
+                        xhr.status === 408 || xhr.status === 429
+                    ) {
+                        u.retry(entry, 'HTTP ' + xhr.status);
+                    } else {
+                        u.fail(entry, 'HTTP ' + xhr.status);
+                    }
+                    u.pump();
+                }, false);
+                xhr.addEventListener('error', function () {
+                    u.finish(entry);
+                    u.retry(entry, 'network error');
+                    u.pump();
+                }, false);
+                xhr.addEventListener('abort', function () {
+                    u.finish(entry);
+                    u.fail(entry, 'aborted');
+                    u.pump();
+                }, false);
+                xhr.open('POST', 'upload', true);
+                xhr.send(fd);
+            };
+            u.render = function () {
+                var loaded = u.finished, now = Date.now(),
+                    p, time, rate;
+                u.running.forEach(function (entry) {
+                    loaded += entry.loaded;
+                });
+                p = u.size > 0 ? Math.floor(loaded / u.size * 100) : 100;
+                time = (now - u.start) / 1000;
+                rate = time > 0 ? loaded / time : 0;
+                u.progress.style.width = (2*p) + 'px';
+                u.p.innerHTML = p;
+                if (!u.idle()) {
+                    u.pf.style.opacity = 1;
+                    u.message.innerHTML =
+                        'Uploading... ' +
+                        u.done + ' / ' + u.total + ' files, ' +
+                        u.kB(loaded) + ' / ' + u.kB(u.size) + '<br>' +
+                        '[avg: ' + Math.floor(rate / 1024) + 'kB/s, ' +
+                        'active: ' + u.active + ', ' +
+                        'retrying: ' + u.waiting + (
+                            u.holdUntil > now ? ', server busy' : ''
+                        ) + ']<br>' +
+                        'elapsed time: ' + Math.floor(time) + 's, ' +
+                        'time left: ' + (
+                            rate > 0 ?
+                                Math.floor((u.size - loaded) / rate) : '?'
+                        ) + 's';
+                } else {
+                    u.pf.style.opacity = 0;
+                    u.message.innerHTML =
+                        u.done + ' / ' + u.total + ' files ' +
+                        '[' + u.kB(u.finished) + ']<br>' +
+                        'uploaded successfully in ' +
+                        Math.floor(time) + 's!' + (
+                            u.failed.length > 0 ?
+                                '<br>failed:<br>' + u.failed.map(
+                                    u.escape
+                                ).join('<br>') : ''
+                        );
+                }
+            };
+            u.walk = function (entry) {
+                var reader;
+                if (entry.isFile) {
+                    entry.file(function (file) {
+                        u.enqueue(file);
+                        u.pump();
+                    });
+                } else if (entry.isDirectory) {
+                    reader = entry.createReader();
+                    (function readAll() {
+                        // readEntries returns directory content in batches
+                        reader.readEntries(function (entries) {
+                            if (entries.length > 0) {
+                                entries.forEach(u.walk);
+                                readAll();
+                            }
+                        });
+                    }());
+                }
+            };
+            u.onDrop = function (evt) {
+                var items = evt.dataTransfer.items, entries = [], i;
+                evt.stopPropagation(); evt.preventDefault();
+                if (items && items.length > 0 && items[0].webkitGetAsEntry) {
+                    // entries have to be obtained synchronously
+                    for (i = 0; i < items.length; i += 1) {
+                        entries.push(items[i].webkitGetAsEntry());
+                    }
+                    entries.forEach(function (entry) {
+                        if (entry) { u.walk(entry); }
+                    });
+                } else if (evt.dataTransfer.files.length > 0) {
+                    Array.prototype.forEach.call(
+                        evt.dataTransfer.files, u.enqueue
+                    );
+                    u.pump();
+                }
+            };
             u.init = function () {
                 u.pf = document.querySelector('.progressFrame');
-                u.pf.innerHTML =
-                    '<div class="progressBar">' +
-                        '<div class="progress"></div>' +
-                    '</div>' +
-                    '<div class="percentage">' +
-                        '[<span class="p">0</span>%]' +
-                    '</div>';
+                u.pf.innerHTML = u.bar();
                 u.progress = document.querySelector('.progress');
                 u.p = document.querySelector('.p');
+                u.list = document.querySelector('.queue');
+                u.parallel = parseInt(
+                    document.querySelector('form')
+                        .getAttribute('data-parallel'), 10
+                ) || 4;
                 u.replaceInput();
                 u.submit = document.querySelector('input[type="submit"]');
-                u.file = u.fs.files.item(0);
                 u.message = document.querySelector('.message');
+                u.reset();
                 u.submit.addEventListener('click', function (evt) {
                     evt.stopPropagation(); evt.preventDefault();
-                    if (u.file) {
-                        u.fs.disabled = true;
-                        this.disabled = u.fs.disabled;
-                        u.message.innerHTML = 'Uploading...';
-                        u.pf.style.opacity = 1;
-                        u.fd = new FormData();
-                        u.fd.append('file', u.file);
-                        u.xhr = new XMLHttpRequest();
-                        u.xhr.addEventListener('load', function () {
-                            u.submit.disabled = false;
-                            u.replaceInput();
-                            u.message.innerHTML =
-                                '"' + u.file.name + '" ' +
-                                '[' + (Math.floor(
-                                    u.file.size / 1024 * 100
-                                ) / 100) + 'kB]<br>' +
-                                'uploaded successfully in ' +
-                                Math.floor((u.now - u.start) / 1000) + 's!';
-                            delete u.fd; delete u.xhr;
-                            delete u.now; delete u.loaded; delete u.start;
-                            u.file = null;
-                            u.pf.style.opacity = 0;
-                        }, false);
-                        u.xhr.upload.addEventListener(
-                            'progress',
-                            function (e) {
-                                var p, now, curRate, avgRate, time, eta;
-                                if (e.lengthComputable) {
-                                    now = Date.now();
-                                    p = Math.floor(e.loaded/e.total*100);
-                                    u.progress.style.width = (2*p) + 'px';
-                                    u.p.innerHTML = p;
-                                    curRate = Math.floor(
-                                        (e.loaded - u.loaded) /
-                                        ((now - u.now) / 1000) / 1024
-                                    );
-                                    avgRate = Math.floor(
-                                        (e.loaded) /
-                                        ((now - u.start) / 1000) / 1024
-                                    );
-                                    time = Math.floor(
-                                        (now - u.start) / 1000
-                                    );
-                                    eta = Math.floor(
-                                        (e.total - e.loaded) / avgRate / 1000
-                                    );
-                                    u.message.innerHTML =
-                                        'Uploading... ' +
-                                        Math.floor(e.loaded/1024) + 'kB / ' +
-                                        Math.floor(e.total/1024) + 'kB<br>' +
-                                        '[cur: ' + curRate + 'kB/s, ' +
-                                        'avg: ' + avgRate + 'kB/s]<br>' +
-                                        'elapsed time: ' + time + 's, ' +
-                                        'time left: ' + eta + 's';
-                                    u.now = now;
-                                    u.loaded = e.loaded;
-                                }
-                            }, false
-                        );
-                        u.xhr.addEventListener('error', function () {
-                            u.message.innerHTML = 'An error occured...';
-                        }, false);
-                        u.xhr.addEventListener('abort', function () {
-                            u.message.innerHTML = 'Aborted...';
-                        }, false);
-                        u.xhr.open('POST', 'upload', true);
-                        u.loaded = 0;
-                        u.now = Date.now();
-                        u.start = u.now;
-                        u.xhr.send(u.fd);
+                    if (u.fs.files.length > 0) {
+                        Array.prototype.forEach.call(u.fs.files, u.enqueue);
+                        u.replaceInput();
+                        u.pump();
                     } else {
                         u.message.innerHTML = 'No file selected.';
                     }
                 }, false);
-                u.message.innerHTML = 'Ready.';
+                document.addEventListener('dragover', function (evt) {
+                    evt.stopPropagation(); evt.preventDefault();
+                }, false);
+                document.addEventListener('drop', u.onDrop, false);
+                u.message.innerHTML =
+                    'Ready. Select or drop files/folders ' +
+                    '(' + u.parallel + ' parallel uploads).';
             };
             if (
                 window.addEventListener  &&  window.removeEventListener  &&
+                window.setTimeout  &&  Array.prototype.forEach  &&
                 XMLHttpRequest  &&  XMLHttpRequestUpload  &&  FormData  &&
                 Date  &&  Date.now  &&  File  &&
                 document.querySelector  &&  document.createElement
@@ -403,6 +1032,290 @@ class Template(object):
 
 
 
+# Upload directory layout. Files can be spread over a tree
+# of subdirectories (by upload date or by a hash prefix of a name),
+# so no single directory grows to millions of entries and both
+# collision checks and file creation stay cheap.
+class Storage(object):
+
+    """Upload directory manager."""
+
+    # available directory layouts
+    layouts = ("none", "date", "hash")
+
+
+    def __init__ (self, root=".", shard="none", threshold=0, digest=False):
+        """Store files under "root" directory using "shard" layout.
+
+        Uploads not bigger than "threshold" bytes are kept in memory
+        and written to disk at once (see SpoolFile).
+        With "digest" set, SHA-256 of uploads is computed as they arrive.
+        """
+
+        if shard not in self.layouts:
+            raise ValueError("unknown directory layout: %s" % shard)
+        self.root = root
+        self.shard = shard
+        self.threshold = threshold
+        self.digest = digest
+        self.created = set()
+
+
+    @staticmethod
+    def secure (filename):
+        """Strip any path components from a client-supplied file name."""
+
+        return ntbasename(posixbasename(filename))
+
+
+    def directory (self, name, create=True):
+        """Directory (created if necessary) for a file of a given name."""
+
+        if self.shard == "date":
+            d = os.path.join(self.root, *time.strftime("%Y %m %d").split())
+        elif self.shard == "hash":
+            import hashlib
+            h = hashlib.md5(utf8_encode(name, e="replace")).hexdigest()
+            d = os.path.join(self.root, h[:2], h[2:4])
+        else:
+            d = self.root
+        if create and d not in self.created:
+            try:
+                os.makedirs(d)
+            except OSError:
+                if not os.path.isdir(d):
+                    raise
+            self.created.add(d)
+        return d
+
+
+    def path (self, name):
+        """Path of a stored file (which may not exist), None if invalid.
+
+        "name" is either a file name (looked up according to the layout,
+        today's directory in case of "date") or a "/"-separated path
+        relative to the root.
+        """
+
+        parts = name.split("/")
+        if any(p != self.secure(p) or p in ("", ".", "..") for p in parts):
+            return None
+        if len(parts) == 1:
+            return os.path.join(self.directory(name, create=False), name)
+        return os.path.join(self.root, *parts)
+
+
+    @staticmethod
+    def exclusive (path, suffix=""):
+        """Create a new file (adding ".dup" while the name is taken).
+
+        Returns its descriptor and path. The file is created with O_EXCL,
+        so two uploads of the same name never get the same file.
+        """
+
+        flags = (
+            os.O_RDWR | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+        )
+        while True:
+            try:
+                return os.open(path + suffix, flags, 438), path + suffix
+            except OSError:
+                if sys.exc_info()[1].errno != errno.EEXIST:
+                    raise
+                path += ".dup"
+
+
+    @staticmethod
+    def link (temp, fn):
+        """Move a finished ".part" file to a free name, return its path.
+
+        The name is "fn" (or "fn.dup", ...). A hard link, unlike a rename,
+        fails if the name is taken, so there's no race between a collision
+        check and the move.
+        """
+
+        target = fn
+        try:
+            while True:
+                try:
+                    os.link(temp, target)
+                    break
+                except OSError:
+                    if sys.exc_info()[1].errno != errno.EEXIST:
+                        raise
+                    target += ".dup"
+        except (AttributeError, OSError):
+            # no hard links (python 2.x on windows, FAT, ...) - claim
+            # the name with an empty file and move the upload over it
+            fd, target = Storage.exclusive(fn)
+            os.close(fd)
+            return Storage.replace(temp, target)
+        os.remove(temp)
+        return target
+
+
+    @staticmethod
+    def replace (temp, fn):
+        """Move a finished ".part" file over "fn", return its path."""
+
+        if hasattr(os, "replace"):
+            os.replace(temp, fn)
+        else:
+            # python 2.x (rename doesn't replace existing files on windows)
+            if os.name == "nt" and os.path.exists(fn):
+                os.remove(fn)
+            os.rename(temp, fn)
+        return fn
+
+
+    def reserve (self, filename):
+        """Pick a name and create a ".part" file for an upload.
+
+        Returns the name, path of the ".part" file and its descriptor.
+        """
+
+        name = self.secure(filename)
+        fd, temp = self.exclusive(
+            os.path.join(self.directory(name), name), ".part"
+        )
+        return name, temp, fd
+
+
+    def commit (self, temp, name):
+        """Give finished upload its final (unique) name, return its path."""
+
+        return self.link(temp, os.path.join(os.path.dirname(temp), name))
+
+
+    def write (self, filename, data):
+        """Write (small) file under a unique name at once, return its path.
+
+        Data goes to a ".part" file first, which is then moved under
+        the final name (see link), so a failed write doesn't leave
+        a truncated file behind and readers never see a partial one.
+        """
+
+        name, temp, fd = self.reserve(filename)
+        try:
+            try:
+                view = memoryview(data)
+                while len(view) > 0:
+                    view = view[os.write(fd, view):]
+            finally:
+                os.close(fd)
+        except Exception:
+            os.remove(temp)
+            raise
+        return self.commit(temp, name)
+
+
+    def spool (self, filename, timer=None):
+        """Create a SpoolFile for an incoming upload."""
+
+        return SpoolFile(self, filename, self.threshold, timer)
+
+
+
+
+# Incoming upload buffered in memory as long as it's small. When it grows
+# over a threshold it spills over to a ".part" file in the upload directory
+# (just like tempfile.SpooledTemporaryFile), otherwise it's written to disk
+# in one go when it's finished (see Storage.write).
+class SpoolFile(object):
+
+    """File-like object receiving an upload."""
+
+    def __init__ (self, storage, filename, threshold, timer=None):
+        """Initialize empty in-memory buffer."""
+
+        self.storage = storage
+        self.filename = filename
+        self.threshold = threshold
+        self.timer = timer or NullTimer()
+        self.buffer = BytesIO()
+        self.file = None
+        self.name = None
+        self.temp = None
+        self.size = 0
+        self.hash = None
+        if storage.digest:
+            import hashlib
+            self.hash = hashlib.sha256()
+
+
+    def write (self, data):
+        """Append data to the buffer or to the ".part" file."""
+
+        self.size += len(data)
+        if self.hash is not None:
+            self.hash.update(data)
+        if self.file is None:
+            if self.size <= self.threshold:
+                return self.buffer.write(data)
+            self.spill()
+        return self.file.write(data)
+
+
+    def spill (self):
+        """Move buffered data to a ".part" file."""
+
+        self.name, self.temp, fd = self.storage.reserve(self.filename)
+        self.file = TimedStream(
+            os.fdopen(fd, "wb+", 1<<16), self.timer, "write"
+        )
+        self.file.write(self.buffer.getvalue())
+        self.buffer = None
+
+
+    def in_memory (self):
+        """Is the whole upload still kept in memory?"""
+
+        return self.file is None
+
+
+    def hexdigest (self):
+        """SHA-256 of the upload (if computed)."""
+
+        return self.hash.hexdigest() if self.hash is not None else None
+
+
+    def commit (self):
+        """Give upload its final name, return its path."""
+
+        if self.file is None:
+            with self.timer.stage("write"):
+                return self.storage.write(
+                    self.filename, self.buffer.getvalue()
+                )
+        self.file.close()
+        with self.timer.stage("rename"):
+            return self.storage.commit(self.temp, self.name)
+
+
+    def discard (self):
+        """Drop an unfinished upload."""
+
+        if self.file is not None:
+            self.file.close()
+            if os.path.exists(self.temp):
+                os.remove(self.temp)
+        self.buffer = None
+
+
+    def close (self):
+        if self.file is not None:
+            self.file.close()
+
+
+    def __getattr__ (self, name):
+        # seek, tell, read, ... of the current storage
+        return getattr(
+            self.buffer if self.file is None else self.file, name
+        )
+
+
+
+
 # FieldStorage class subclassed for override the default choice
 # of storing all files in a temporary directory.
 class FUPFieldStorage(FieldStorage):
@@ -424,26 +1337,1236 @@ class FUPFieldStorage(FieldStorage):
 
 
     def make_file (self, binary=None):
-        """Create secure tempfile in the current directory."""
+        """Create secure spool file (in memory or in the upload directory)."""
 
-        self.secure_filename = ntbasename(posixbasename(self.filename))
-        self.temp_filename = self.secure_filename + ".part"
-        while os.path.exists(self.temp_filename):
-            self.secure_filename += ".dup"
-            self.temp_filename = self.secure_filename + ".part"
+        storage = self.__orig_env.get("pyfup.storage") or Storage()
+        spool = storage.spool(
+            self.filename, self.__orig_env.get("pyfup.timer")
+        )
+        # to be discarded if the request doesn't complete
+        self.__orig_env.setdefault("pyfup.spools", []).append(spool)
         print(
             "%s - - [%s] --> receiving \"%s\" (%s) %s" % (
                 self.__orig_env["REMOTE_ADDR"]
                     if "REMOTE_ADDR" in self.__orig_env else "-",
                 time.strftime("%d/%b/%Y %H:%M:%S"),
-                self.secure_filename,
+                Storage.secure(self.filename),
                 self.headers["content-type"],
                 self.__orig_env["CONTENT_LENGTH"]
                     if "CONTENT_LENGTH" in self.__orig_env else ""
             ),
             file=sys.stderr
         )
-        return open(self.temp_filename, "wb+", buffering=1<<16)
+        return spool
+
+
+
+
+# Delta (rsync-style) transfer of a new version of a file already stored
+# on the server. The server describes its copy with a signature - a weak
+# (rolling Adler-32) and a strong (MD5) checksum of each fixed-size block -
+# and the client, looking for those blocks in its own version, sends only
+# the data the server doesn't have, interleaved with instructions to copy
+# blocks it does have. The new version is assembled in a ".part" file,
+# verified (SHA-256) and renamed over the old one.
+class Delta(object):
+
+    """Signatures, delta encoding and patching of files."""
+
+    # first bytes of a delta stream
+    magic = b"PYFUPD1\n"
+
+    # modulus of Adler-32 sums
+    modulus = 65521
+
+    # misses (blocks sent literally) between searches for shifted data
+    search_every = 16
+
+
+    @staticmethod
+    def block_size (size):
+        """Block size for a file of a given size (about its square root)."""
+
+        block = 1<<10
+        while block * block < size and block < 1<<20:
+            block <<= 1
+        return block
+
+
+    @staticmethod
+    def signature (fn, block=0):
+        """Signature of a file: its size, block size and block checksums."""
+
+        import hashlib
+        import zlib
+        size = os.path.getsize(fn)
+        block = block or Delta.block_size(size)
+        out = [struct.pack(">QI", size, block)]
+        with open(fn, "rb") as f:
+            for data in iter(lambda: f.read(block), b""):
+                out.append(
+                    struct.pack(">I", zlib.adler32(data) & 0xffffffff) +
+                    hashlib.md5(data).digest()
+                )
+        return b"".join(out)
+
+
+    @staticmethod
+    def encode (fn, signature):
+        """Instructions rebuilding file "fn" out of a signed file.
+
+        Returns block size, a list of ("C", index, count) - copy "count"
+        blocks starting at block "index" - and ("L", offset, length) -
+        send "length" bytes of "fn" starting at "offset" - instructions,
+        and SHA-256 (raw) of "fn".
+        """
+
+        import hashlib
+        import mmap
+        import zlib
+        if len(signature) < 12 or (len(signature) - 12) % 20:
+            raise ValueError("invalid signature")
+        _, block = struct.unpack(">QI", signature[:12])
+        if block < 1:
+            raise ValueError("invalid signature")
+        blocks = {}
+        for i, o in enumerate(range(12, len(signature) - 19, 20)):
+            weak, strong = struct.unpack(">I16s", signature[o:o + 20])
+            blocks.setdefault(weak, []).append((strong, i))
+        ops = []
+
+        def find (data, weak):
+            if weak not in blocks:
+                return None
+            strong = hashlib.md5(data).digest()
+            for s, i in blocks[weak]:
+                if s == strong:
+                    return i
+            return None
+
+        def copy (i):
+            if ops and ops[-1][0] == "C" and sum(ops[-1][1:]) == i:
+                ops[-1] = ("C", ops[-1][1], ops[-1][2] + 1)
+            else:
+                ops.append(("C", i, 1))
+
+        def literal (offset, length):
+            if ops and ops[-1][0] == "L" and sum(ops[-1][1:]) == offset:
+                ops[-1] = ("L", ops[-1][1], ops[-1][2] + length)
+            elif length > 0:
+                ops.append(("L", offset, length))
+
+        digest = hashlib.sha256()
+        size = os.path.getsize(fn)
+        if size == 0:
+            return block, ops, digest.digest()
+        modulus = Delta.modulus
+        with open(fn, "rb") as f:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for o in range(0, size, 1<<20):
+                digest.update(m[o:o + (1<<20)])
+            pos = misses = 0
+            while pos + block <= size:
+                data = m[pos:pos + block]
+                weak = zlib.adler32(data) & 0xffffffff
+                i = find(data, weak)
+                if i is not None:
+                    copy(i)
+                    pos += block
+                    misses = 0
+                    continue
+                if misses < 2 or misses % Delta.search_every == 0:
+                    # roll the checksum over the next block, looking for
+                    # data shifted by an insertion or deletion (blocks
+                    # changed in place are found by the check above)
+                    window = bytearray(m[pos:pos + 2 * block])
+                    a, b = weak & 0xffff, weak >> 16
+                    for k in range(1, len(window) - block + 1):
+                        x = window[k - 1]
+                        a = (a - x + window[k + block - 1]) % modulus
+                        b = (b - block * x + a - 1) % modulus
+                        if (b << 16 | a) in blocks:
+                            i = find(bytes(window[k:k + block]), b << 16 | a)
+                            if i is not None:
+                                break
+                    if i is not None:
+                        literal(pos, k)
+                        copy(i)
+                        pos += k + block
+                        misses = 0
+                        continue
+                literal(pos, block)
+                pos += block
+                misses += 1
+            if pos < size:
+                data = m[pos:size]
+                i = find(data, zlib.adler32(data) & 0xffffffff)
+                if i is not None:
+                    copy(i)
+                else:
+                    literal(pos, size - pos)
+        finally:
+            m.close()
+        return block, ops, digest.digest()
+
+
+    @staticmethod
+    def length (ops):
+        """Length of a delta stream made of given instructions."""
+
+        return len(Delta.magic) + 4 + 33 + sum(
+            13 if op[0] == "C" else 9 + op[2] for op in ops
+        )
+
+
+    @staticmethod
+    def write (fn, block, ops, digest, send, chunk_size=1<<16):
+        """Send a delta stream (literal data read from "fn")."""
+
+        out = [Delta.magic + struct.pack(">I", block)]
+        buffered = len(out[0])
+        with open(fn, "rb") as f:
+            for op, a, b in ops:
+                if op == "C":
+                    out.append(b"C" + struct.pack(">QI", a, b))
+                    buffered += 13
+                else:
+                    out.append(b"L" + struct.pack(">Q", b))
+                    f.seek(a)
+                    while b > 0:
+                        data = f.read(min(chunk_size, b))
+                        if not data:
+                            raise IOError("file has shrunk during upload")
+                        out.append(data)
+                        buffered += len(data)
+                        b -= len(data)
+                        if buffered >= chunk_size:
+                            send(b"".join(out))
+                            out, buffered = [], 0
+                if buffered >= chunk_size:
+                    send(b"".join(out))
+                    out, buffered = [], 0
+        out.append(b"E" + digest)
+        send(b"".join(out))
+
+
+    @staticmethod
+    def patch (stream, base, out, limit=0):
+        """Rebuild a file from "base" and a delta stream into "out".
+
+        Returns size and SHA-256 (raw) of the result along with
+        the checksum it's expected to have (sent by the client).
+        Malformed streams raise ValueError, truncated ones IOError.
+        """
+
+        import hashlib
+
+        def read (n):
+            data = b""
+            while len(data) < n:
+                chunk = stream.read(n - len(data))
+                if not chunk:
+                    raise IOError("incomplete request body")
+                data += chunk
+            return data
+
+        def put (data):
+            written[0] += len(data)
+            if 0 < limit < written[0]:
+                raise ValueError("file exceeds the limit of %u bytes" % limit)
+            digest.update(data)
+            out.write(data)
+
+        if read(len(Delta.magic)) != Delta.magic:
+            raise ValueError("not a delta stream")
+        block, = struct.unpack(">I", read(4))
+        if block < 1:
+            raise ValueError("invalid block size")
+        size = os.fstat(base.fileno()).st_size
+        digest = hashlib.sha256()
+        written = [0]
+        while True:
+            op = read(1)
+            if op == b"C":
+                index, count = struct.unpack(">QI", read(12))
+                start = index * block
+                left = min(count * block, size - start)
+                if count < 1 or left <= (count - 1) * block:
+                    raise ValueError("copy of a nonexistent block")
+                base.seek(start)
+                while left > 0:
+                    data = base.read(min(1<<16, left))
+                    if not data:
+                        raise IOError("base file has shrunk")
+                    put(data)
+                    left -= len(data)
+            elif op == b"L":
+                left, = struct.unpack(">Q", read(8))
+                while left > 0:
+                    data = stream.read(min(1<<16, left))
+                    if not data:
+                        raise IOError("incomplete request body")
+                    put(data)
+                    left -= len(data)
+            elif op == b"E":
+                return written[0], digest.digest(), read(32)
+            else:
+                raise ValueError("unknown instruction")
+
+
+
+
+# Post-upload processing steps. Each one is called (in a worker process)
+# with a path of a finished upload and a dict of options and returns
+# a path of the file for the next step (which can be different,
+# e.g. after compression or moving the file elsewhere). Steps leave
+# their input in place - it's removed once the step is journaled (see
+# PostProcessor), so a job interrupted by a crash goes on with the step
+# it was running. Outputs are written under temporary names and get
+# names not taken yet (".dup" suffixes), so they are either complete or
+# missing and never take the place of another upload.
+def post_output (fn, write):
+    """Let "write" fill a new file named "fn" (or "fn.dup", ...)."""
+
+    fd, temp = Storage.exclusive(fn, ".part")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+    except Exception:
+        os.remove(temp)
+        raise
+    return Storage.link(temp, fn)
+
+
+def post_sha256 (path, options):
+    """Write a "sha256sum"-compatible checksum sidecar file."""
+
+    import hashlib
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1<<16), b""):
+            digest.update(chunk)
+    with open(path + ".sha256.part", "w") as f:
+        f.write("%s  %s\n" % (digest.hexdigest(), os.path.basename(path)))
+    os.rename(path + ".sha256.part", path + ".sha256")
+    return path
+
+
+def post_gzip (path, options):
+    """Replace file with its gzip-compressed version."""
+
+    import gzip
+
+    def write (f):
+        with open(path, "rb") as src:
+            with gzip.GzipFile(os.path.basename(path), "wb", 9, f) as dst:
+                shutil.copyfileobj(src, dst, 1<<16)
+    return post_output(path + ".gz", write)
+
+
+def post_zstd (path, options):
+    """Replace file with its zstd-compressed version."""
+
+    import zstandard
+
+    def write (f):
+        with open(path, "rb") as src:
+            zstandard.ZstdCompressor().copy_stream(src, f)
+    return post_output(path + ".zst", write)
+
+
+def post_quarantine (path, options):
+    """Move file to the quarantine directory."""
+
+    d = options["quarantine_dir"]
+    try:
+        os.makedirs(d)
+    except OSError:
+        if not os.path.isdir(d):
+            raise
+    fn = os.path.join(d, os.path.basename(path))
+    target = fn
+    try:
+        while True:
+            try:
+                os.link(path, target)
+                return target
+            except OSError:
+                if sys.exc_info()[1].errno != errno.EEXIST:
+                    raise
+                target += ".dup"
+    except (AttributeError, OSError):
+        # no hard links, another filesystem, ... - copy it
+
+        def write (f):
+            with open(path, "rb") as src:
+                shutil.copyfileobj(src, f, 1<<16)
+        return post_output(fn, write)
+
+
+def run_step (step, path, options):
+    """Run a post-processing step (in a worker process)."""
+
+    builtin = {
+        "sha256" : post_sha256,
+        "gzip" : post_gzip,
+        "zstd" : post_zstd,
+        "quarantine" : post_quarantine
+    }
+    if step in builtin:
+        fun = builtin[step]
+    else:
+        # custom step given as "module:function"
+        module, _, name = step.partition(":")
+        fun = getattr(__import__(module, fromlist=[name]), name)
+    return fun(path, options)
+
+
+
+
+# Spool directories and journals are shared by consecutive generations
+# of server processes (see Main.reload), but only one of them at a time
+# may work on them - the new one takes over when the draining one exits.
+def take_over (path):
+    """Wait for an exclusive lock on a file (held until process exit)."""
+
+    try:
+        import fcntl
+    except ImportError:
+        # no reloads there (no SIGHUP) - nobody to share with
+        return None
+    f = open(path, "a")
+    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    return f
+
+
+
+
+# Queue of post-processing jobs. Jobs are journaled to disk (so pending
+# ones survive a restart) and run on a process pool with a bounded number
+# of jobs in flight - the rest waits in the queue instead of piling up
+# in the pool. Uploads don't wait for their post-processing, unless
+# the queue is full. Failed jobs stay in the journal (and are retried
+# after restart). The journal is owned by one server process at a time,
+# jobs submitted before it's taken over wait in memory. Journal entries
+# are ["+", upload] (new job), [">", upload, step, output, input] (step
+# done, its input not removed yet unless None) and ["-", upload] (done).
+class PostProcessor(object):
+
+    """Persistent, bounded post-upload pipeline."""
+
+    def __init__ (
+        self, steps, workers=2, journal="pyfup-post.journal",
+        backlog=None, queue_size=1000, options={}
+    ):
+        """Set up process pool and feeder (resuming journaled jobs)."""
+
+        import json
+        try:
+            import queue
+        except ImportError:
+            import Queue as queue
+        try:
+            from concurrent.futures import ProcessPoolExecutor
+        except ImportError:
+            raise ValueError(
+                "post-processing requires concurrent.futures " +
+                "(python 3.2+ or \"futures\" package)"
+            )
+
+        self.dumps = json.dumps
+        self.steps = list(steps)
+        self.options = dict(options)
+        self.executor = ProcessPoolExecutor(workers)
+        self.slots = Semaphore(backlog or 2 * workers)
+        self.pending = queue.Queue(queue_size)
+        self.journal = journal
+        self.lock = Lock()
+        self.outstanding = {}
+        self.progress = {}
+        self.entries = 0
+        self.owner = None
+        self.owned = Event()
+        self.deferred = []
+        self.closed = False
+
+        feeder = Thread(target=self.feed)
+        feeder.daemon = True
+        feeder.start()
+
+
+    def load (self):
+        """Take over the journal, return jobs to resume."""
+
+        import json
+        self.owner = take_over(self.journal + ".lock")
+        with self.lock:
+            if os.path.isfile(self.journal):
+                with open(self.journal) as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            # torn write
+                            continue
+                        self.account(entry)
+            resumed = [
+                path for path, count in self.outstanding.items()
+                    for _ in range(count)
+            ]
+            # submitted meanwhile - already queued
+            for entry in self.deferred:
+                self.account(entry)
+            self.deferred = []
+            self.compact()
+            self.owned.set()
+        return resumed
+
+
+    def account (self, entry):
+        """Track jobs which are not finished yet (and their progress)."""
+
+        op, path = entry[:2]
+        if op == "+":
+            self.outstanding[path] = self.outstanding.get(path, 0) + 1
+        elif path not in self.outstanding:
+            return
+        elif op == ">":
+            self.progress[path] = list(entry[2:])
+        else:
+            self.outstanding[path] -= 1
+            self.progress.pop(path, None)
+            if self.outstanding[path] == 0:
+                del self.outstanding[path]
+
+
+    def compact (self):
+        """Rewrite the journal so it contains only unfinished jobs."""
+
+        with open(self.journal + ".tmp", "w") as f:
+            for path, count in self.outstanding.items():
+                for _ in range(count):
+                    f.write(self.dumps(["+", path]) + "\n")
+                if path in self.progress:
+                    f.write(
+                        self.dumps([">", path] + self.progress[path]) + "\n"
+                    )
+        os.rename(self.journal + ".tmp", self.journal)
+        self.entries = sum(self.outstanding.values()) + len(self.progress)
+
+
+    def record (self, *entry):
+        """Append a job state change to the journal."""
+
+        with self.lock:
+            if not self.owned.is_set():
+                self.deferred.append(entry)
+                return
+            self.account(entry)
+            with open(self.journal, "a") as f:
+                f.write(self.dumps(entry) + "\n")
+            self.entries += 1
+            if (
+                self.entries > 10000 and
+                self.entries > 4 * len(self.outstanding)
+            ):
+                self.compact()
+
+
+    def submit (self, path, env=None, info=None):
+        """Queue post-processing of a finished upload.
+
+        Blocks while the queue is full (the job is already journaled).
+        """
+
+        self.record("+", path)
+        self.pending.put(path)
+
+
+    def feed (self):
+        """Pass jobs to the process pool as slots become free."""
+
+        for path in self.load():
+            self.start(path)
+        while True:
+            self.start(self.pending.get())
+
+
+    def start (self, path):
+        """Run a job on the process pool (once there's a free slot).
+
+        Resumed jobs go on with the step after the last journaled one.
+        """
+
+        self.slots.acquire()
+        with self.lock:
+            step, current, previous = self.progress.get(path, (-1, path, None))
+        if previous is not None:
+            self.consumed(path, step, current, previous)
+        self.run(path, step + 1, current)
+
+
+    def run (self, path, step, current):
+        """Run a step of a job (or finish the job after its last step)."""
+
+        if step >= len(self.steps):
+            return self.done(path, current)
+        with self.lock:
+            if self.closed:
+                # left in the journal for the next owner
+                self.slots.release()
+                return
+            future = self.executor.submit(
+                run_step, self.steps[step], current, self.options
+            )
+        future.add_done_callback(
+            lambda f: self.stepped(path, step, current, f)
+        )
+
+
+    def stepped (self, path, step, current, future):
+        """Step completion callback."""
+
+        e = future.exception()
+        if e is not None:
+            return self.done(path, current, e)
+        result = future.result()
+        if result != current:
+            self.record(">", path, step, result, current)
+            self.consumed(path, step, result, current)
+        else:
+            self.record(">", path, step, result, None)
+        self.run(path, step + 1, result)
+
+
+    def consumed (self, path, step, current, previous):
+        """Remove input of a journaled step."""
+
+        try:
+            os.remove(previous)
+        except OSError:
+            # gone already (e.g. moved by a custom step)
+            pass
+        self.record(">", path, step, current, None)
+
+
+    def done (self, path, result, e=None):
+        """Job completion."""
+
+        self.slots.release()
+        if e is None and not os.path.exists(result):
+            e = IOError("no such file: %s" % result)
+        if e is None:
+            message = "-> \"%s\"" % result
+        else:
+            message = "failed (%s: %s), kept in journal" % (
+                type(e).__name__, e
+            )
+        print(
+            "- - - [%s] post: \"%s\" %s" % (
+                time.strftime("%d/%b/%Y %H:%M:%S"), path, message
+            ),
+            file=sys.stderr
+        )
+        if e is None:
+            self.record("-", path)
+
+
+    def close (self):
+        """Stop starting jobs, wait for the ones in flight.
+
+        Jobs submitted before the journal was taken over have to be
+        journaled, so it waits for that too.
+        """
+
+        with self.lock:
+            self.closed = True
+            deferred = bool(self.deferred)
+        if deferred:
+            self.owned.wait()
+        self.executor.shutdown(True)
+        with self.lock:
+            if self.owner is not None:
+                # journal is up to date - the next owner can take over
+                self.owner.close()
+                self.owner = None
+
+
+
+
+# Replication of finished uploads to peer pyfup nodes. Each upload is
+# hard-linked (or copied) into a per-peer spool directory - it's both
+# a retry queue surviving restarts and a snapshot immune to renames done
+# by post-processing. One thread per peer streams queued files (through
+# a shared bandwidth limit) to the peer's "/replicate" endpoint, signed
+# with HMAC-SHA256 of a shared key, along with their SHA-256 checksums.
+# A spool directory is worked on by one server process at a time, files
+# queued before it's taken over are sent afterwards. New versions of files
+# (see View.delta) are spooled with an "r" mark and replace the peer's
+# copy instead of being stored next to it. Files the peer rejects for
+# their content are moved to a ".rejected" subdirectory, other failures
+# (including misconfiguration, like a bad key) are retried.
+class Replicator(object):
+
+    """Asynchronous replication of uploads to peer nodes."""
+
+    # size of a chunk of file read from disk and sent at once
+    chunk_size = 1<<14
+
+    # maximum delay between retries (in seconds)
+    max_backoff = 60
+
+    # maximum accepted clock skew of signed requests (in seconds)
+    max_skew = 300
+
+    # responses rejecting a file itself (invalid path, too large, corrupted)
+    rejected = (400, 413, 422)
+
+
+    def __init__ (
+        self, peers, key, root=".", spool="pyfup-replica",
+        rate=0, timeout=30, insecure=False
+    ):
+        """Set up per-peer queues and workers (resuming spooled files)."""
+
+        try:
+            from urllib.parse import urlsplit
+        except ImportError:
+            from urlparse import urlsplit
+
+        self.key = key
+        self.root = root
+        self.timeout = timeout
+        self.insecure = insecure
+        self.bucket = TokenBucket(rate, max(rate, 1<<16)) if rate else None
+        self.lock = Lock()
+        self.counter = 0
+        self.stopped = Event()
+        self.peers = []
+        for url in peers:
+            u = urlsplit(url if "://" in url else "http://" + url)
+            peer = {
+                "url" : url,
+                "ssl" : u.scheme == "https",
+                "host" : u.hostname,
+                "port" : u.port or (443 if u.scheme == "https" else 80),
+                "path" : u.path.rstrip("/") + "/replicate",
+                "spool" : os.path.join(spool, "".join(
+                    c if c.isalnum() or c in "-." else "_"
+                        for c in u.netloc + u.path.rstrip("/")
+                )),
+                "queue" : [],
+                "cond" : Condition(),
+                "sent" : 0,
+                "bytes" : 0,
+                "failures" : 0,
+                "last_error" : None,
+                "last_sent" : None,
+                "lock" : None,
+                "active" : False,
+                "worker" : None
+            }
+            if not os.path.isdir(os.path.join(peer["spool"], ".rejected")):
+                os.makedirs(os.path.join(peer["spool"], ".rejected"))
+            self.peers.append(peer)
+            peer["worker"] = Thread(target=self.worker, args=(peer,))
+            peer["worker"].daemon = True
+            peer["worker"].start()
+
+
+    @staticmethod
+    def sign (key, path, digest, length, stamp, replace=False):
+        """Signature of a replication request."""
+
+        import hashlib
+        import hmac
+        return hmac.new(
+            utf8_encode(key),
+            utf8_encode("\n".join(
+                [path, digest, str(length), stamp] +
+                (["replace"] if replace else [])
+            )),
+            hashlib.sha256
+        ).hexdigest()
+
+
+    @staticmethod
+    def verify (key, path, digest, length, stamp, signature, replace=False):
+        """Check signature and freshness of a replication request."""
+
+        import hmac
+        try:
+            if abs(time.time() - float(stamp)) > Replicator.max_skew:
+                return False
+        except ValueError:
+            return False
+        expected = Replicator.sign(key, path, digest, length, stamp, replace)
+        if hasattr(hmac, "compare_digest"):
+            return hmac.compare_digest(expected, signature)
+        return expected == signature
+
+
+    def submit (self, path, env=None, info=None):
+        """Queue replication of a finished upload to all peers."""
+
+        try:
+            from urllib.parse import quote
+        except ImportError:
+            from urllib import quote
+
+        if env is not None and env.get("pyfup.replica"):
+            # received from a peer - not replicated any further
+            return
+        rel = os.path.relpath(path, self.root).replace(os.sep, "/")
+        with self.lock:
+            self.counter += 1
+            # enqueue time (for lag), replace mark and a relative path
+            # in spool file name
+            name = "%016d.%04d%s-%s" % (
+                int(time.time() * 1e6), self.counter % 10000,
+                "r" if info and info.get("replace") else "",
+                quote(rel, safe="")
+            )
+        for peer in self.peers:
+            fn = os.path.join(peer["spool"], name)
+            try:
+                try:
+                    os.link(path, fn)
+                except (AttributeError, OSError):
+                    # no hard links (platform, filesystem boundary, ...)
+                    temp = os.path.join(peer["spool"], ".tmp-" + name)
+                    shutil.copyfile(path, temp)
+                    os.rename(temp, fn)
+            except (IOError, OSError):
+                e = sys.exc_info()[1]
+                self.log(peer, "\"%s\" not queued (%s)" % (rel, e))
+                continue
+            with peer["cond"]:
+                if name not in peer["queue"]:
+                    peer["queue"].append(name)
+                peer["cond"].notify()
+
+
+    def connect (self, peer):
+        """Create (lazily connecting) HTTP(S) connection to a peer."""
+
+        try:
+            from http.client import HTTPConnection, HTTPSConnection
+        except ImportError:
+            from httplib import HTTPConnection, HTTPSConnection
+        if peer["ssl"]:
+            import ssl
+            if self.insecure:
+                context = ssl._create_unverified_context()
+            else:
+                context = ssl.create_default_context()
+            return HTTPSConnection(
+                peer["host"], peer["port"], timeout=self.timeout,
+                context=context
+            )
+        return HTTPConnection(peer["host"], peer["port"], timeout=self.timeout)
+
+
+    def worker (self, peer):
+        """Send queued files to a peer, retrying failed transfers."""
+
+        try:
+            from http.client import HTTPException
+            from urllib.parse import unquote
+        except ImportError:
+            from httplib import HTTPException
+            from urllib import unquote
+
+        peer["lock"] = take_over(os.path.join(peer["spool"], ".lock"))
+        with peer["cond"]:
+            # left by previous owners (and spooled meanwhile)
+            peer["queue"] = sorted(set(peer["queue"]) | set(
+                fn for fn in os.listdir(peer["spool"])
+                    if not fn.startswith(".")
+            ))
+            peer["active"] = True
+        conn = self.connect(peer)
+        backoff = 1
+        while True:
+            with peer["cond"]:
+                while not peer["queue"] and not self.stopped.is_set():
+                    peer["cond"].wait()
+                if self.stopped.is_set():
+                    break
+                name = peer["queue"][0]
+            label = unquote(name.split("-", 1)[1])
+            fn = os.path.join(peer["spool"], name)
+            if not os.path.exists(fn):
+                # removed by hand - nothing to send
+                self.log(peer, "\"%s\" gone from spool" % label)
+                with peer["cond"]:
+                    peer["queue"].pop(0)
+                continue
+            try:
+                response = self.send(conn, peer, name)
+                status, reason = response.status, response.reason
+            except (IOError, OSError, socket.error, HTTPException):
+                conn.close()
+                e = sys.exc_info()[1]
+                status, reason = 0, str(e)
+                response = None
+            if 200 <= status < 300 or status in self.rejected:
+                try:
+                    if status in self.rejected:
+                        # sending it again won't help - kept for inspection
+                        self.log(peer, "\"%s\" rejected (%s %s)" % (
+                            label, status, reason
+                        ))
+                        os.rename(
+                            fn, os.path.join(peer["spool"], ".rejected", name)
+                        )
+                    else:
+                        self.log(peer, "\"%s\" %s %s" % (
+                            label, status, reason
+                        ))
+                        os.remove(fn)
+                except OSError:
+                    pass
+                with peer["cond"]:
+                    peer["queue"].pop(0)
+                backoff = 1
+                continue
+            peer["failures"] += 1
+            peer["last_error"] = "%s %s" % (status or "", reason)
+            delay = Client.retry_after(response)
+            if delay is None:
+                delay = backoff
+                backoff = min(2 * backoff, self.max_backoff)
+            self.log(peer, "\"%s\" failed - %s %s, retry in %us" % (
+                label, status or "", reason, delay
+            ))
+            self.stopped.wait(delay)
+        conn.close()
+
+
+    def close (self):
+        """Stop sending (after files in transfer), leave the rest spooled."""
+
+        self.stopped.set()
+        for peer in self.peers:
+            with peer["cond"]:
+                peer["cond"].notify_all()
+                # still waiting for the spool - not sending anything
+                active = peer["active"]
+            if active:
+                peer["worker"].join()
+
+
+    def send (self, conn, peer, name):
+        """Stream one spooled file to a peer, return the response."""
+
+        import hashlib
+        fn = os.path.join(peer["spool"], name)
+        mark, path = name.split("-", 1)
+        replace = mark.endswith("r")
+        digest = hashlib.sha256()
+        with open(fn, "rb") as f:
+            for chunk in iter(lambda: f.read(1<<16), b""):
+                digest.update(chunk)
+        digest = digest.hexdigest()
+        length = os.path.getsize(fn)
+        stamp = "%.3f" % time.time()
+
+        conn.putrequest("POST", peer["path"])
+        conn.putheader("Content-Type", "application/octet-stream")
+        conn.putheader("Content-Length", str(length))
+        conn.putheader("X-Pyfup-Path", path)
+        conn.putheader("X-Pyfup-SHA256", digest)
+        conn.putheader("X-Pyfup-Time", stamp)
+        if replace:
+            conn.putheader("X-Pyfup-Replace", "1")
+        conn.putheader("X-Pyfup-Signature", self.sign(
+            self.key, path, digest, length, stamp, replace
+        ))
+        conn.endheaders()
+        with open(fn, "rb") as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), b""):
+                if self.bucket is not None:
+                    delay = self.bucket.reserve(len(chunk))
+                    if delay > 0:
+                        time.sleep(delay)
+                conn.send(chunk)
+        response = conn.getresponse()
+        response.read()
+        if 200 <= response.status < 300:
+            peer["sent"] += 1
+            peer["bytes"] += length
+            peer["last_sent"] = time.time()
+        return response
+
+
+    def log (self, peer, message):
+        """Log replication event."""
+
+        print(
+            "- - - [%s] replicate -> %s: %s" % (
+                time.strftime("%d/%b/%Y %H:%M:%S"), peer["url"], message
+            ),
+            file=sys.stderr
+        )
+
+
+    def status (self, env, config={}):
+        """Replication state (queue lengths and lag) of all peers."""
+
+        import json
+        now = time.time()
+        result = []
+        for peer in self.peers:
+            with peer["cond"]:
+                queued = len(peer["queue"])
+                oldest = peer["queue"][0] if queued else None
+            try:
+                rejected = len(
+                    os.listdir(os.path.join(peer["spool"], ".rejected"))
+                )
+            except OSError:
+                rejected = 0
+            result.append({
+                "url" : peer["url"],
+                "queued" : queued,
+                "rejected" : rejected,
+                "lag" : round(
+                    now - int(oldest.split(".", 1)[0]) / 1e6, 3
+                ) if oldest else 0,
+                "sent" : peer["sent"],
+                "bytes" : peer["bytes"],
+                "failures" : peer["failures"],
+                "last_error" : peer["last_error"],
+                "last_sent" : peer["last_sent"]
+            })
+        return (
+            "200 OK", [
+                ("Content-Type", "application/json; charset=utf-8"),
+                ("Cache-Control", "no-cache")
+            ], utf8_encode(json.dumps({"peers" : result}, indent=1))
+        )
+
+
+
+
+# Index of finished uploads kept in an SQLite database, so questions like
+# "who uploaded what, when and how big" don't need directory scans
+# or log parsing. Records are queued by request threads and inserted
+# in batches (one transaction each) by a single writer thread.
+class Index(object):
+
+    """Persistent upload index."""
+
+    # maximum number of records inserted in one transaction
+    batch = 1000
+
+    # maximum delay of an insert (in seconds)
+    interval = 1.0
+
+    # default and maximum number of records returned by a query
+    page = 100
+    max_page = 1000
+
+    schema = (
+        """CREATE TABLE IF NOT EXISTS uploads (
+            id INTEGER PRIMARY KEY,
+            name TEXT,
+            path TEXT,
+            size INTEGER,
+            sha256 TEXT,
+            client TEXT,
+            user TEXT,
+            started REAL,
+            finished REAL
+        )""",
+        "CREATE INDEX IF NOT EXISTS uploads_finished ON uploads (finished)",
+        "CREATE INDEX IF NOT EXISTS uploads_name ON uploads (name)",
+        "CREATE INDEX IF NOT EXISTS uploads_sha256 ON uploads (sha256)",
+        "CREATE INDEX IF NOT EXISTS uploads_client ON uploads (client)",
+        "CREATE INDEX IF NOT EXISTS uploads_user ON uploads (user)"
+    )
+
+    # columns of a record (in order)
+    columns = (
+        "id", "name", "path", "size", "sha256", "client", "user",
+        "started", "finished"
+    )
+
+
+    def __init__ (self, database="pyfup-index.sqlite", root="."):
+        """Create the database (if needed) and start the writer thread."""
+
+        import sqlite3
+        try:
+            import queue
+        except ImportError:
+            import Queue as queue
+
+        self.database = database
+        self.root = root
+        self.pending = queue.Queue()
+        self.empty = queue.Empty
+        db = sqlite3.connect(database)
+        try:
+            # readers don't block the writer (and vice versa)
+            db.execute("PRAGMA journal_mode=WAL")
+            for statement in self.schema:
+                db.execute(statement)
+            db.commit()
+        finally:
+            db.close()
+
+        self.writer = Thread(target=self.write)
+        self.writer.daemon = True
+        self.writer.start()
+
+
+    def submit (self, path, env=None, info=None):
+        """Queue a record of a finished upload."""
+
+        env = env or {}
+        info = info or {}
+        now = time.time()
+        if "size" in info:
+            size = info["size"]
+        else:
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                size = None
+        self.pending.put((
+            info.get("name", os.path.basename(path)),
+            os.path.relpath(path, self.root).replace(os.sep, "/"),
+            size,
+            info.get("sha256"),
+            env.get("REMOTE_ADDR"),
+            env.get("pyfup.user"),
+            env.get("pyfup.started", now),
+            now
+        ))
+
+
+    def write (self):
+        """Insert queued records in batches."""
+
+        import sqlite3
+        db = sqlite3.connect(self.database)
+        db.execute("PRAGMA synchronous=NORMAL")
+        closed = False
+        while not closed:
+            records = [self.pending.get()]
+            deadline = clock() + self.interval
+            while len(records) < self.batch and records[-1] is not None:
+                timeout = deadline - clock()
+                if timeout <= 0:
+                    break
+                try:
+                    records.append(self.pending.get(True, timeout))
+                except self.empty:
+                    break
+            if records[-1] is None:
+                # queued by close() - everything before it is written
+                closed = True
+                records.pop()
+                if not records:
+                    break
+            try:
+                with db:
+                    db.executemany(
+                        "INSERT INTO uploads (%s) VALUES (%s)" % (
+                            ", ".join(self.columns[1:]),
+                            ", ".join("?" * len(self.columns[1:]))
+                        ), records
+                    )
+            except sqlite3.Error:
+                e = sys.exc_info()[1]
+                print(
+                    "- - - [%s] index: %u record(s) lost (%s)" % (
+                        time.strftime("%d/%b/%Y %H:%M:%S"), len(records), e
+                    ),
+                    file=sys.stderr
+                )
+        db.close()
+
+
+    def close (self):
+        """Write all queued records and stop the writer thread."""
+
+        self.pending.put(None)
+        self.writer.join()
+
+
+    def query (self, env, config={}):
+        """JSON list of indexed uploads, newest first.
+
+        Query string filters: "name" (exact, or a pattern with "*"),
+        "sha256", "client", "user", "since"/"until" (unix timestamps
+        of upload end) and "min_size"/"max_size". Pagination: "limit"
+        and "before" (id, given in "next" of the previous page).
+        """
+
+        import json
+        import sqlite3
+        try:
+            from urllib.parse import parse_qs
+        except ImportError:
+            from urlparse import parse_qs
+
+        params = dict(
+            (k, v[-1]) for k, v in
+                parse_qs(env.get("QUERY_STRING", "")).items()
+        )
+        where, values = [], []
+        try:
+            if "name" in params:
+                if "*" in params["name"]:
+                    where.append("name GLOB ?")
+                else:
+                    where.append("name = ?")
+                values.append(params["name"])
+            for key in ("sha256", "client", "user"):
+                if key in params:
+                    where.append("%s = ?" % key)
+                    values.append(params[key])
+            for key, condition, convert in (
+                ("since", "finished >= ?", float),
+                ("until", "finished < ?", float),
+                ("min_size", "size >= ?", int),
+                ("max_size", "size <= ?", int),
+                ("before", "id < ?", int)
+            ):
+                if key in params:
+                    where.append(condition)
+                    values.append(convert(params[key]))
+            limit = min(int(params.get("limit", self.page)), self.max_page)
+        except ValueError:
+            return (
+                "400 Bad Request", [
+                    ("Content-Type", "text/plain; charset=utf-8")
+                ], utf8_encode("Invalid query parameter.")
+            )
+
+        db = sqlite3.connect(self.database)
+        try:
+            rows = db.execute(
+                "SELECT %s FROM uploads%s ORDER BY id DESC LIMIT ?" % (
+                    ", ".join(self.columns),
+                    " WHERE " + " AND ".join(where) if where else ""
+                ), values + [max(limit, 0)]
+            ).fetchall()
+        finally:
+            db.close()
+        return (
+            "200 OK", [
+                ("Content-Type", "application/json; charset=utf-8"),
+                ("Cache-Control", "no-cache")
+            ], utf8_encode(json.dumps({
+                "uploads" : [dict(zip(self.columns, row)) for row in rows],
+                "next" : rows[-1][0] if len(rows) == limit > 0 else None
+            }, indent=1))
+        )
 
 
 
@@ -462,17 +2585,19 @@ class View(object):
                 action="upload"
                 method="post"
                 enctype="multipart/form-data"
+                data-parallel="%u"
             >
                 <fieldset>
-                    <input type="file" name="file" class="fselect">
-                    <input type="submit" value="Upload File">
+                    <input type="file" name="file" class="fselect" multiple>
+                    <input type="submit" value="Upload Files">
                 </fieldset>
             </form>
             <div class="progressFrame"></div>
             <div class="message">
                 Static uploading (no dynamic progress updates).
             </div>
-        """)
+            <div class="queue"></div>
+        """ % config["parallel"])
         markup += dedent("""\
             <script
                 type="text/javascript"
@@ -498,52 +2623,527 @@ class View(object):
         else:
             def enc (s):
                 return utf8_encode(s)
+
         def t (env, config={}):
+            value = getattr(Template, name)
             return (
                 "200 OK", [
                     ("Content-Type", content_type)
-                ], enc(getattr(Template, name))
+                ], enc(value() if callable(value) else value)
             )
         return t
 
 
+    @staticmethod
+    def rendered (view):
+        """Serve a response rendered (and compressed) only once.
+
+        It's done on the first request, not on import of the module.
+        """
+
+        cache = []
+
+        def r (env, config={}):
+            if not cache:
+                status, headers, body = view({}, config)
+                cache.append((status, headers, body, GzipGlue.compress(body)))
+            status, headers, body, gzipped = cache[0]
+            if env.get("HTTP_ACCEPT_ENCODING", "").find("gzip") > -1:
+                return (status, headers + [
+                    ("Content-Encoding", "gzip"),
+                    ("Vary", "Content-Encoding")
+                ], gzipped)
+            return (status, list(headers), body)
+        return r
+
+
+    @staticmethod
+    def completed (env, path, info=None):
+        """Pass a finished upload to all registered hooks.
+
+        "info" is a dict with "name" (as given by the client), "size"
+        and "sha256" (or None) of the file, "replace" is set when it's
+        a new version of an existing file (see View.delta).
+        """
+
+        for hook in env.get("pyfup.hooks", ()):
+            hook.submit(path, env, info)
+
+
+    # content types of request bodies handled by upload_tar
+    tar_types = (
+        "application/x-tar", "application/tar", "application/x-gtar",
+        "application/gzip", "application/x-gzip",
+        "application/x-compressed-tar"
+    )
+
+
     @staticmethod
     def upload (env, config={}):
         """File upload action (called from an upload form)."""
 
-        form = FUPFieldStorage(fp=env["wsgi.input"], environ=env)
-        form_file = form["file"] if "file" in form else None
-
-        if form_file is not None and form_file.filename:
-            form_file.file.close()
+        if (
+            env.get("CONTENT_TYPE", "").split(";")[0].strip().lower()
+                in View.tar_types
+        ):
+            return View.upload_tar(env, config)
 
-            fn = form_file.secure_filename
-            while os.path.exists(fn):
-                fn += ".dup"
-            os.rename(form_file.temp_filename, fn)
+        timer = env.get("pyfup.timer", NullTimer())
+        storage = env.get("pyfup.storage") or Storage()
+        with timer.stage("parse"):
+            try:
+                form = FUPFieldStorage(fp=env["wsgi.input"], environ=env)
+            except IOError:
+                # client disconnected or has been evicted
+                for spool in env.get("pyfup.spools", ()):
+                    spool.discard()
+                e = sys.exc_info()[1]
+                return (
+                    "408 Request Timeout" if isinstance(e, SlowClient)
+                        else "400 Bad Request", [
+                        ("Content-Type", "text/plain; charset=utf-8")
+                    ], utf8_encode("Upload incomplete (%s)." % e)
+                )
+            form_file = form["file"] if "file" in form else None
 
+        # "multiple" file input yields a list of fields
+        if form_file is None:
+            form_files = []
+        elif isinstance(form_file, list):
+            form_files = [f for f in form_file if f.filename]
+        else:
+            form_files = [form_file] if form_file.filename else []
+
+        bytes_read = 0
+        for form_file in form_files:
+            spool = form_file.file
+            if not isinstance(spool, SpoolFile):
+                # FieldStorage keeps tiny files in memory by itself
+                # (without calling make_file)
+                spool = storage.spool(form_file.filename, timer)
+                spool.write(form_file.file.getvalue())
+            fn = spool.commit()
+            bytes_read += spool.size
+            View.completed(env, fn, {
+                "name" : form_file.filename,
+                "size" : spool.size,
+                "sha256" : spool.hexdigest()
+            })
+
+        if len(form_files) == 1:
             status = "201 Created"
             message = (
                 "The file \"%s\" was uploaded successfully!"
-                    % form_file.filename
+                    % form_files[0].filename
+            )
+
+        elif len(form_files) > 1:
+            status = "201 Created"
+            message = (
+                "%u files were uploaded successfully!" % len(form_files)
             )
-            bytes_read = os.stat(fn).st_size
 
         else:
             status = "200 OK"
             message = "No file was uploaded."
-            bytes_read = 0
 
-        return (
-            status, [
-                ("Content-Type", "text/html; charset=utf-8")
-            ], utf8_encode(Template.html(body=dedent("""\
-                <p>Done!</p>
-                <p>%s</p>
-                <p>bytes uploaded: %u</p>
-                <p>(<a href="..">upload another file</a>)</p>
-            """ % (message, bytes_read))))
-        )
+        with timer.stage("respond"):
+            return (
+                status, [
+                    ("Content-Type", "text/html; charset=utf-8")
+                ], utf8_encode(Template.html(body=dedent("""\
+                    <p>Done!</p>
+                    <p>%s</p>
+                    <p>bytes uploaded: %u</p>
+                    <p>(<a href="..">upload more files</a>)</p>
+                """ % (message, bytes_read))))
+            )
+
+
+
+
+    @staticmethod
+    def upload_tar (env, config={}):
+        """Unpack (optionally gzipped) tar stream into the upload directory.
+
+        Regular files are extracted (flattened, with the same name
+        sanitization as in case of form uploads) as the data arrives.
+        Directories, links and special files are skipped. A JSON manifest
+        of written files is returned.
+        """
+
+        import json
+        import tarfile
+
+        timer = env.get("pyfup.timer", NullTimer())
+        storage = env.get("pyfup.storage") or Storage()
+        try:
+            length = int(env.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            length = 0
+        manifest = []
+        spool = None
+        try:
+            archive = tarfile.open(
+                fileobj=RequestBody(env["wsgi.input"], length), mode="r|*"
+            )
+            for member in archive:
+                name = Storage.secure(member.name)
+                if not member.isfile() or name in ("", ".", ".."):
+                    continue
+                with timer.stage("parse"):
+                    spool = storage.spool(name, timer)
+                    shutil.copyfileobj(
+                        archive.extractfile(member), spool, 1<<16
+                    )
+                fn = spool.commit()
+                manifest.append({
+                    "name" : member.name,
+                    "path" : os.path.relpath(fn, storage.root),
+                    "size" : member.size
+                })
+                View.completed(env, fn, {
+                    "name" : member.name,
+                    "size" : spool.size,
+                    "sha256" : spool.hexdigest()
+                })
+                spool = None
+            archive.close()
+            status = "201 Created" if manifest else "200 OK"
+            result = {"files" : manifest}
+        except (tarfile.TarError, EOFError, IOError, OSError):
+            if spool is not None:
+                spool.discard()
+            e = sys.exc_info()[1]
+            status = "400 Bad Request"
+            result = {
+                "files" : manifest,
+                "error" : "%s: %s" % (type(e).__name__, e)
+            }
+        print(
+            "%s - - [%s] --> unpacked %u file(s) from tar stream" % (
+                env.get("REMOTE_ADDR", "-"),
+                time.strftime("%d/%b/%Y %H:%M:%S"),
+                len(manifest)
+            ),
+            file=sys.stderr
+        )
+
+        with timer.stage("respond"):
+            return (
+                status, [
+                    ("Content-Type", "application/json; charset=utf-8")
+                ], utf8_encode(json.dumps(result, indent=1))
+            )
+
+
+
+
+    @staticmethod
+    def replicate (env, config={}):
+        """Receive a file replicated from a peer node (see Replicator).
+
+        The file is stored under the same relative path as on the peer,
+        after its signature and SHA-256 checksum are verified. A new
+        version of a file ("X-Pyfup-Replace") replaces it atomically.
+        Files received this way are not replicated any further.
+        """
+
+        import hashlib
+        try:
+            from urllib.parse import unquote
+        except ImportError:
+            from urllib import unquote
+
+        def reply (status, message):
+            return (
+                status, [
+                    ("Content-Type", "text/plain; charset=utf-8")
+                ], utf8_encode(message)
+            )
+
+        def sha256 (fn):
+            digest = hashlib.sha256()
+            with open(fn, "rb") as f:
+                for chunk in iter(lambda: f.read(1<<16), b""):
+                    digest.update(chunk)
+            return digest.hexdigest()
+
+        storage = env.get("pyfup.storage") or Storage()
+        path = env.get("HTTP_X_PYFUP_PATH", "")
+        digest = env.get("HTTP_X_PYFUP_SHA256", "").lower()
+        replace = env.get("HTTP_X_PYFUP_REPLACE") == "1"
+        try:
+            length = int(env.get("CONTENT_LENGTH") or "")
+        except ValueError:
+            return reply("411 Length Required", "Content-Length required.")
+        if not Replicator.verify(
+            config.get("replicate_key") or "", path, digest, length,
+            env.get("HTTP_X_PYFUP_TIME", ""),
+            env.get("HTTP_X_PYFUP_SIGNATURE", ""), replace
+        ):
+            return reply("403 Forbidden", "Invalid signature.")
+        parts = unquote(path).split("/")
+        if any(p != Storage.secure(p) or p in ("", ".", "..") for p in parts):
+            return reply("400 Bad Request", "Invalid path.")
+
+        fn = os.path.join(storage.root, *parts)
+        d = os.path.dirname(fn)
+        try:
+            os.makedirs(d)
+        except OSError:
+            if not os.path.isdir(d):
+                raise
+        fd, temp = Storage.exclusive(fn, ".part")
+        received = hashlib.sha256()
+        try:
+            with os.fdopen(fd, "wb") as f:
+                left = length
+                while left > 0:
+                    chunk = env["wsgi.input"].read(min(1<<16, left))
+                    if not chunk:
+                        raise IOError("incomplete request body")
+                    received.update(chunk)
+                    f.write(chunk)
+                    left -= len(chunk)
+        except (IOError, OSError):
+            os.remove(temp)
+            return reply("400 Bad Request", str(sys.exc_info()[1]))
+        if received.hexdigest() != digest:
+            os.remove(temp)
+            return reply("422 Unprocessable Entity", "Checksum mismatch.")
+
+        if os.path.exists(fn) and sha256(fn) == digest:
+            # retransmission (e.g. after a lost response)
+            os.remove(temp)
+            return reply("200 OK", "Already replicated.")
+        if replace:
+            fn = Storage.replace(temp, fn)
+        else:
+            fn = Storage.link(temp, fn)
+        print(
+            "%s - - [%s] --> replicated \"%s\" (%u bytes%s)" % (
+                env.get("REMOTE_ADDR", "-"),
+                time.strftime("%d/%b/%Y %H:%M:%S"),
+                unquote(path), length, ", replaced" if replace else ""
+            ),
+            file=sys.stderr
+        )
+        env["pyfup.replica"] = True
+        View.completed(env, fn, {
+            "name" : unquote(path),
+            "size" : length,
+            "sha256" : digest,
+            "replace" : replace
+        })
+        return reply("201 Created", "Replicated.")
+
+
+
+
+    @staticmethod
+    def signature (env, config={}):
+        """Block signature of a stored file (see Delta).
+
+        The file is given by "name" (or "path") in the query string,
+        block size can be chosen with "block".
+        """
+
+        try:
+            from urllib.parse import parse_qs
+        except ImportError:
+            from urlparse import parse_qs
+
+        params = dict(
+            (k, v[-1]) for k, v in
+                parse_qs(env.get("QUERY_STRING", "")).items()
+        )
+        storage = env.get("pyfup.storage") or Storage()
+        fn = storage.path(params.get("path") or params.get("name") or "")
+        try:
+            block = int(params.get("block") or 0)
+        except ValueError:
+            block = -1
+        if fn is None or not 0 <= block <= 1<<24:
+            return (
+                "400 Bad Request", [
+                    ("Content-Type", "text/plain; charset=utf-8")
+                ], utf8_encode("Invalid file name or block size.")
+            )
+        # also sent along with "404", so clients can tell a missing
+        # file from a server not accepting deltas
+        path = "/".join(os.path.relpath(fn, storage.root).split(os.sep))
+        if not os.path.isfile(fn):
+            return (
+                "404 Not Found", [
+                    ("Content-Type", "text/plain; charset=utf-8"),
+                    ("X-Pyfup-Path", path)
+                ], utf8_encode("No such file.")
+            )
+        return (
+            "200 OK", [
+                ("Content-Type", "application/octet-stream"),
+                ("X-Pyfup-Path", path)
+            ], Delta.signature(fn, block)
+        )
+
+
+    @staticmethod
+    def delta (env, config={}):
+        """Update a stored file with a delta stream (see Delta).
+
+        The file is given by "name" (or "path") in the query string.
+        Its new version is assembled in a ".part" file and, once its
+        SHA-256 checksum matches, atomically replaces the old one.
+        """
+
+        import json
+        try:
+            from urllib.parse import parse_qs
+        except ImportError:
+            from urlparse import parse_qs
+
+        def reply (status, message):
+            return (
+                status, [
+                    ("Content-Type", "text/plain; charset=utf-8")
+                ], utf8_encode(message)
+            )
+
+        params = dict(
+            (k, v[-1]) for k, v in
+                parse_qs(env.get("QUERY_STRING", "")).items()
+        )
+        timer = env.get("pyfup.timer", NullTimer())
+        storage = env.get("pyfup.storage") or Storage()
+        fn = storage.path(params.get("path") or params.get("name") or "")
+        if fn is None:
+            return reply("400 Bad Request", "Invalid file name.")
+        if not os.path.isfile(fn):
+            return reply("404 Not Found", "No such file.")
+
+        fd, temp = Storage.exclusive(fn, ".part")
+        try:
+            with timer.stage("parse"):
+                with os.fdopen(fd, "wb") as out:
+                    with open(fn, "rb") as base:
+                        size, digest, expected = Delta.patch(
+                            env["wsgi.input"], base, out,
+                            config.get("max_size", 0)
+                        )
+        except (ValueError, IOError, OSError):
+            os.remove(temp)
+            e = sys.exc_info()[1]
+            return reply(
+                "408 Request Timeout" if isinstance(e, SlowClient)
+                    else "400 Bad Request", "Delta rejected (%s)." % e
+            )
+        if digest != expected:
+            os.remove(temp)
+            return reply("422 Unprocessable Entity", "Checksum mismatch.")
+        Storage.replace(temp, fn)
+
+        path = "/".join(os.path.relpath(fn, storage.root).split(os.sep))
+        digest = binascii.hexlify(digest).decode("ascii")
+        print(
+            "%s - - [%s] --> patched \"%s\" (%u bytes, %s delta)" % (
+                env.get("REMOTE_ADDR", "-"),
+                time.strftime("%d/%b/%Y %H:%M:%S"),
+                path, size, env.get("CONTENT_LENGTH") or "?"
+            ),
+            file=sys.stderr
+        )
+        # a new version of the file, not a new file (see View.replicate)
+        View.completed(env, fn, {
+            "name" : os.path.basename(fn),
+            "size" : size,
+            "sha256" : digest,
+            "replace" : True
+        })
+        with timer.stage("respond"):
+            return (
+                "200 OK", [
+                    ("Content-Type", "application/json; charset=utf-8")
+                ], utf8_encode(json.dumps({
+                    "path" : path,
+                    "size" : size,
+                    "sha256" : digest
+                }, indent=1))
+            )
+
+
+
+
+# Admission control of uploads: limits of concurrently processed uploads
+# (overall and per client). Uploads over the limit can wait (for a while)
+# in a short line, otherwise they are rejected before their bodies
+# are read, so an overloaded server sheds load instead of thrashing.
+class Admission(object):
+
+    """Concurrent uploads limiter."""
+
+    def __init__ (self, total=0, per_client=0, line=0, wait=5.0):
+        """Set limits (0 - unlimited), waiting line size and time."""
+
+        self.total = total
+        self.per_client = per_client
+        self.line = line
+        self.wait = wait
+        self.active = 0
+        self.clients = {}
+        self.waiting = 0
+        self.cond = Condition()
+
+
+    def fits (self, client):
+        """Can one more upload of a given client be started?"""
+
+        return (
+            (not self.total or self.active < self.total) and
+            (
+                not self.per_client or
+                self.clients.get(client, 0) < self.per_client
+            )
+        )
+
+
+    def acquire (self, client):
+        """Try to admit an upload, return False if it has been rejected."""
+
+        with self.cond:
+            if not self.fits(client):
+                if self.waiting >= self.line:
+                    return False
+                deadline = clock() + self.wait
+                self.waiting += 1
+                try:
+                    while not self.fits(client):
+                        left = deadline - clock()
+                        if left <= 0:
+                            return False
+                        self.cond.wait(left)
+                finally:
+                    self.waiting -= 1
+            self.active += 1
+            self.clients[client] = self.clients.get(client, 0) + 1
+            return True
+
+
+    def release (self, client):
+        """Mark upload of a given client as finished."""
+
+        with self.cond:
+            self.active -= 1
+            self.clients[client] -= 1
+            if self.clients[client] == 0:
+                del self.clients[client]
+            self.cond.notify_all()
+
+
+    def retry_after (self):
+        """Suggested delay (in seconds) for rejected clients."""
+
+        return 1 + int(self.wait)
 
 
 
@@ -572,11 +3172,112 @@ class Application(object):
             ),
             "/upload" : View.upload
         }
+        # routes subject to admission control
+        self.uploads = set(["/upload", "/replicate"])
+        # routes authenticating requests by themselves (not by basic auth)
+        self.signed = set(["/replicate"])
         self.config = {
             "no_js" : False,
-            "auth" : "__NO_AUTH__"
+            "parallel" : 4,
+            "auth" : "__NO_AUTH__",
+            "profile" : 0,
+            "profile_dir" : "pyfup-profile",
+            "upload_dir" : ".",
+            "shard" : "none",
+            "spool_threshold" : 1<<20,
+            "rate_client" : 0,
+            "rate_user" : 0,
+            "rate_total" : 0,
+            "max_uploads" : 0,
+            "max_client_uploads" : 0,
+            "upload_line" : 0,
+            "upload_wait" : 5.0,
+            "post" : [],
+            "post_workers" : 2,
+            "post_journal" : "pyfup-post.journal",
+            "quarantine_dir" : "quarantine",
+            "peers" : [],
+            "replicate_key" : None,
+            "replicate_rate" : 0,
+            "replicate_dir" : "pyfup-replica",
+            "replicate_insecure" : False,
+            "index" : None,
+            "delta" : False,
+            "max_size" : 0
         }
         self.config.update(config)
+        self.storage = Storage(
+            self.config["upload_dir"], self.config["shard"],
+            self.config["spool_threshold"],
+            digest=bool(self.config["index"])
+        )
+        self.admission = (
+            Admission(
+                self.config["max_uploads"],
+                self.config["max_client_uploads"],
+                self.config["upload_line"], self.config["upload_wait"]
+            ) if (
+                self.config["max_uploads"] or
+                self.config["max_client_uploads"]
+            ) else None
+        )
+        self.shaper = (
+            Shaper(
+                self.config["rate_client"], self.config["rate_user"],
+                self.config["rate_total"]
+            ) if (
+                self.config["rate_client"] or self.config["rate_user"] or
+                self.config["rate_total"]
+            ) else None
+        )
+        self.hooks = []
+        if self.config["peers"] and not self.config["replicate_key"]:
+            raise ValueError("replication to peers requires a shared key")
+        if self.config["replicate_key"]:
+            self.urls["/replicate"] = View.replicate
+        if self.config["peers"]:
+            # first, so a file is spooled before post-processing touches it
+            replicator = Replicator(
+                self.config["peers"], self.config["replicate_key"],
+                root=self.config["upload_dir"],
+                spool=self.config["replicate_dir"],
+                rate=self.config["replicate_rate"],
+                insecure=self.config["replicate_insecure"]
+            )
+            self.hooks.append(replicator)
+            self.urls["/replication"] = replicator.status
+        if self.config["delta"]:
+            self.urls["/signature"] = View.signature
+            self.urls["/delta"] = View.delta
+            # hashing a stored file costs about as much as receiving it
+            self.uploads.update(["/signature", "/delta"])
+        if self.config["index"]:
+            index = Index(self.config["index"], self.config["upload_dir"])
+            self.hooks.append(index)
+            self.urls["/uploads"] = index.query
+        if self.config["post"]:
+            self.hooks.append(PostProcessor(
+                self.config["post"],
+                workers=self.config["post_workers"],
+                journal=self.config["post_journal"],
+                options={"quarantine_dir" : self.config["quarantine_dir"]}
+            ))
+        self.profiler = (
+            Profiler(self.config["profile"], self.config["profile_dir"])
+                if self.config["profile"] > 0 else None
+        )
+        # static pages depend only on config, so render
+        # (and compress) them once instead of on every request
+        for url in ("/", "/favicon.ico", "/m.css", "/m.js"):
+            self.urls[url] = View.rendered(self.urls[url])
+
+
+    def close (self):
+        """Let hooks finish their pending work (server is shutting down)."""
+
+        for hook in self.hooks:
+            if hasattr(hook, "close"):
+                hook.close()
 
 
     def authorized (self, env):
@@ -598,11 +3299,38 @@ class Application(object):
             return False
 
 
+    def user (self, env):
+        """Name of an authenticated user (or None)."""
+
+        if self.config["auth"] == "__NO_AUTH__":
+            return None
+        try:
+            return base64.b64decode(
+                env["HTTP_AUTHORIZATION"].split(" ")[1]
+            ).decode("utf-8").split(":", 1)[0]
+        except Exception:
+            return None
+
+
     def dispatch (self, env):
         """Basic, url-based action dispatcher."""
 
         if env["PATH_INFO"] in self.urls:
-            if self.authorized(env):
+            if env["PATH_INFO"] in self.signed or self.authorized(env):
+                if env["PATH_INFO"] in self.uploads and self.too_big(env):
+                    return (
+                        "413 Payload Too Large", [
+                            ("Content-Type", "text/plain; charset=utf-8")
+                        ], utf8_encode(
+                            "Upload exceeds the limit of %u bytes."
+                                % self.config["max_size"]
+                        )
+                    )
+                if (
+                    self.admission is not None and
+                    env["PATH_INFO"] in self.uploads
+                ):
+                    return self.admit(env)
                 return self.urls[env["PATH_INFO"]](env, self.config)
             else:
                 return (
@@ -624,15 +3352,70 @@ class Application(object):
             )
 
 
-    def __call__ (self, env, start_response):
-        """A callable defined for a WSGI entry point."""
+    def too_big (self, env):
+        """Is request body over the size limit?"""
+
+        try:
+            return 0 < self.config["max_size"] < int(
+                env.get("CONTENT_LENGTH") or 0
+            )
+        except ValueError:
+            return False
+
+
+    def admit (self, env):
+        """Run upload action if admission control lets it in."""
+
+        client = env.get("REMOTE_ADDR")
+        if not self.admission.acquire(client):
+            print(
+                "%s - - [%s] upload rejected: \"too many uploads\"" % (
+                    client or "-", time.strftime("%d/%b/%Y %H:%M:%S")
+                ),
+                file=sys.stderr
+            )
+            return (
+                "503 Service Unavailable", [
+                    ("Content-Type", "text/plain; charset=utf-8"),
+                    ("Retry-After", str(self.admission.retry_after()))
+                ], utf8_encode("Too many concurrent uploads, retry later.")
+            )
+        try:
+            return self.urls[env["PATH_INFO"]](env, self.config)
+        finally:
+            self.admission.release(client)
+
+
+    def respond (self, env):
+        """Dispatch request, optionally compress and time the response."""
+
+        env["pyfup.storage"] = self.storage
+        env["pyfup.hooks"] = self.hooks
+        env["pyfup.started"] = time.time()
+        env["pyfup.user"] = self.user(env)
+        timing = self.config["profile"] > 0
+        timer = env["pyfup.timer"] = StageTimer() if timing else NullTimer()
+        shaped = None
+        if self.shaper is not None and env.get("CONTENT_LENGTH"):
+            shaped = env["wsgi.input"] = self.shaper.stream(
+                env["wsgi.input"], env.get("REMOTE_ADDR"), env["pyfup.user"],
+                timer
+            )
+        if timing:
+            env["wsgi.input"] = TimedStream(env["wsgi.input"], timer, "read")
 
-        status, headers, body = self.dispatch(env)
+        try:
+            status, headers, body = self.dispatch(env)
+        finally:
+            if shaped is not None:
+                shaped.close()
         if (
             "HTTP_ACCEPT_ENCODING" in env and
-            env["HTTP_ACCEPT_ENCODING"].find("gzip") > -1
+            env["HTTP_ACCEPT_ENCODING"].find("gzip") > -1 and
+            "Content-Encoding" not in dict(headers)
         ):
-            body = GzipGlue.compress(body)
+            with timer.stage("compress"):
+                body = GzipGlue.compress(body)
             headers += [
                 ("Content-Encoding", "gzip"),
                 ("Vary", "Content-Encoding")
@@ -640,24 +3423,348 @@ class Application(object):
         headers.append(
             ("Content-Length", str(len(body)))
         )
+        if timing:
+            headers.append(("Server-Timing", timer.header()))
+        return status, headers, body
+
+
+    def __call__ (self, env, start_response):
+        """A callable defined for a WSGI entry point."""
+
+        if self.profiler is not None:
+            status, headers, body = self.profiler.run(self.respond, env)
+        else:
+            status, headers, body = self.respond(env)
         start_response(status, headers)
         return iter([body])
 
 
 
 
+# Request body ("wsgi.input") limited to Content-Length bytes. Keeps
+# track of what was consumed, so the connection can be reused for
+# the next request only if the application read the whole body.
+# For requests with "Expect: 100-continue" the interim response is sent
+# just before the first read - a request rejected without looking
+# at its body doesn't make the client transfer it.
+class RequestBody(object):
+
+    """Length-limited input stream."""
+
+    def __init__ (
+        self, stream, length, expect=None, progress=None, paused=None
+    ):
+        """Wrap stream, allow to read at most "length" bytes from it.
+
+        "expect" is called once, before the body is read for the first time,
+        "progress" after each read with the number of bytes received,
+        "paused" with the time reading is going to be held back by a reader.
+        """
+
+        self.stream = stream
+        self.remaining = length
+        self.expect = expect
+        self.progress = progress
+        self.paused = paused
+
+
+    def proceed (self):
+        """Let the client know it can send the body (if it waits for it)."""
+
+        if self.expect is not None:
+            expect, self.expect = self.expect, None
+            expect()
+
+
+    def read (self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        if size > 0:
+            self.proceed()
+        data = self.stream.read(size) if size > 0 else b""
+        return self.received(size, data)
+
+
+    def readline (self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        if size > 0:
+            self.proceed()
+        data = self.stream.readline(size) if size > 0 else b""
+        return self.received(size, data)
+
+
+    def pause (self, seconds):
+        """Announce that the body won't be read for a while."""
+
+        if self.paused is not None and self.remaining > 0:
+            self.paused(seconds)
+
+
+    def received (self, size, data):
+        """Account for data read from the stream."""
+
+        self.remaining -= len(data)
+        if size > 0 and not data:
+            # client disconnected (or was evicted) - don't let parsers
+            # take a truncated body for a complete one
+            self.remaining = 0
+            raise IOError("incomplete request body")
+        if self.progress is not None and data:
+            self.progress(len(data))
+        return data
+
+
+    def readlines (self, hint=-1):
+        return list(iter(self.readline, b""))
+
+
+    def __iter__ (self):
+        return iter(self.readline, b"")
+
+
+    def drain (self, limit):
+        """Discard rest of the body if it's not bigger than limit."""
+
+        if self.remaining > limit or self.expect is not None:
+            # too big or not sent at all (client waits for "100 Continue")
+            return False
+        try:
+            while self.remaining > 0:
+                self.read(1<<16)
+        except IOError:
+            return False
+        return True
+
+
+
+
+# Raised when reading of a request body is given up because the client
+# sends it too slowly.
+class SlowClient(IOError):
+
+    """Client evicted for sending a request too slowly."""
+
+
+
+
+# Deadlines of connections. Request handler threads arm a deadline before
+# each blocking phase (waiting for the next request, reading headers,
+# receiving the body) and a single thread checks them once a second,
+# running eviction action (socket shutdown) of expired ones - a blocked
+# read then returns and the thread is freed.
+class Watchdog(object):
+
+    """Connection deadlines enforcer."""
+
+    def __init__ (self, period=1.0):
+        """Start checking deadlines every "period" seconds."""
+
+        self.period = period
+        self.deadlines = {}
+        self.evictions = {}
+        self.lock = Lock()
+        checker = Thread(target=self.run)
+        checker.daemon = True
+        checker.start()
+
+
+    def arm (self, key, timeout, action):
+        """Call "action" unless deadline is re-armed/disarmed in time."""
+
+        with self.lock:
+            self.deadlines[key] = (clock() + timeout, action)
+
+
+    def disarm (self, key):
+        """Remove a deadline."""
+
+        with self.lock:
+            self.deadlines.pop(key, None)
+
+
+    def count (self, reason):
+        """Count an eviction, return the total number of evictions."""
+
+        with self.lock:
+            self.evictions[reason] = self.evictions.get(reason, 0) + 1
+            return sum(self.evictions.values())
+
+
+    def run (self):
+        """Evict connections with expired deadlines."""
+
+        while True:
+            time.sleep(self.period)
+            now = clock()
+            with self.lock:
+                expired = [
+                    (key, action) for key, (deadline, action)
+                        in self.deadlines.items() if deadline <= now
+                ]
+                for key, action in expired:
+                    del self.deadlines[key]
+            for key, action in expired:
+                try:
+                    action()
+                except Exception:
+                    pass
+
+
+
+
+# Activity counters of server processes, kept in shared memory, so
+# the main process can show them on the console. Each process writes
+# its own row of the array without any locks or messages: counters only
+# ever grow (an increment lost in a race between threads just makes them
+# lag slightly) and gauges are overwritten by a sampling thread.
+class Stats(object):
+
+    """Shared-memory counters of server processes."""
+
+    # totals since start
+    counters = (
+        "connections", "requests", "errors_4xx", "errors_5xx",
+        "received", "sent", "evicted"
+    )
+
+    # current values
+    gauges = ("open", "uploads")
+
+
+    def __init__ (self, rows=2):
+        """Allocate shared array with a row for each of "rows" processes."""
+
+        from multiprocessing.sharedctypes import RawArray
+        self.fields = self.counters + self.gauges
+        self.index = dict((f, i) for i, f in enumerate(self.fields))
+        self.array = RawArray("d", len(self.fields) * rows)
+        self.offset = 0
+
+
+    def row (self, n):
+        """Counters of the n-th process (sharing the same array)."""
+
+        import copy
+        view = copy.copy(self)
+        view.offset = n * len(self.fields)
+        return view
+
+
+    def add (self, field, amount=1):
+        """Increase a counter."""
+
+        self.array[self.offset + self.index[field]] += amount
+
+
+    def set (self, field, value):
+        """Set a gauge."""
+
+        self.array[self.offset + self.index[field]] = value
+
+
+    def response (self, code, size):
+        """Count a response of a given status code and body size."""
+
+        self.add("requests")
+        try:
+            code = int(code)
+        except (TypeError, ValueError):
+            code = 0
+        if 400 <= code < 500:
+            self.add("errors_4xx")
+        elif code >= 500:
+            self.add("errors_5xx")
+        try:
+            self.add("sent", int(size))
+        except (TypeError, ValueError):
+            pass
+
+
+    def total (self):
+        """Dict of values summed over all processes."""
+
+        n = len(self.fields)
+        values = self.array[:]
+        return dict(
+            (f, sum(values[i::n])) for i, f in enumerate(self.fields)
+        )
+
+
+
+
+# Used when nobody's watching, so the code paths stay the same.
+class NullStats(Stats):
+
+    """Counters which don't count anything."""
+
+    def __init__ (self):
+        pass
+
+
+    def add (self, field, amount=1):
+        pass
+
+
+    def set (self, field, value):
+        pass
+
+
+
+
+# ServerHandler speaking HTTP/1.1 with persistent connections
+# whenever client's request allows that.
+class FUPServerHandler(ServerHandler):
+
+    """WSGI response writer."""
+
+    def cleanup_headers (self):
+        """Announce closing of a connection (if it's going to happen)."""
+
+        ServerHandler.cleanup_headers(self)
+        if self.request_handler.close_connection:
+            self.headers["Connection"] = "close"
+
+
+
+
 # WSGIRequestHandler class subclassed to log eventually occuring
 # SSL socket exceptions in a nice one-liner without long traceback
+# and to serve multiple requests over persistent (keep-alive) connections.
 class FUPRequestHandler(WSGIRequestHandler):
 
     """WSGI protocol."""
 
+    # let BaseHTTPRequestHandler negotiate persistent connections
+    protocol_version = "HTTP/1.1"
+
+    # unread request body of up to that size is discarded
+    # (instead of closing the connection)
+    drain_limit = 1<<16
+
+    # reason of eviction of the connection (if evicted)
+    evicted = None
+
+    # is the connection waiting for the next request?
+    idle = False
+
+    # is a request body being received?
+    receiving = False
+
+
     def handle (self):
         """Default request handler."""
 
+        server = self.server
+        with server.changed:
+            server.active.add(self)
+        server.stats.add("connections")
         # python 2.x and 3.x compatible try-except code
         try:
-            WSGIRequestHandler.handle(self)
+            self.close_connection = True
+            self.handle_one_request()
+            while not self.close_connection:
+                self.handle_one_request()
         except:
             e = sys.exc_info()
             print(
@@ -671,6 +3778,194 @@ class FUPRequestHandler(WSGIRequestHandler):
                 ),
                 file=sys.stderr
             )
+        finally:
+            with server.changed:
+                server.active.discard(self)
+                server.changed.notify_all()
+
+
+    def handle_one_request (self):
+        """Read and serve a single request from a connection."""
+
+        server = self.server
+        first = not hasattr(self, "raw_requestline")
+        if first:
+            self.arm(server.header_timeout, "request headers timeout")
+        else:
+            with server.changed:
+                if server.draining:
+                    self.close_connection = True
+                    return
+                self.idle = True
+            self.arm(server.keepalive_timeout, "idle connection")
+        self.raw_requestline = self.rfile.readline(65537)
+        self.idle = False
+        if not self.raw_requestline or self.evicted:
+            self.close_connection = True
+            return
+        if not first:
+            self.arm(server.header_timeout, "request headers timeout")
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ""
+            self.request_version = ""
+            self.command = ""
+            self.send_error(414)
+            self.close_connection = True
+            return
+        if self.evicted or not self.parse_request():
+            # an error code has been sent (or connection is gone)
+            self.close_connection = True
+            return
+
+        env = self.get_environ()
+        if env.get("HTTP_TRANSFER_ENCODING", "identity").lower() != "identity":
+            # chunked request bodies are not supported - don't take them
+            # for empty ones
+            self.send_error(411, "Content-Length required")
+            self.close_connection = True
+            return
+        try:
+            length = int(env.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            length = 0
+        if length > 0:
+            self.arm(server.rate_window, "upload stalled")
+            self.samples = deque([(clock(), 0)])
+            self.received = 0
+            self.receiving = True
+        else:
+            server.watchdog.disarm(self)
+        body = RequestBody(
+            self.rfile, length,
+            self.send_continue if (
+                self.request_version == "HTTP/1.1" and
+                env.get("HTTP_EXPECT", "").lower() == "100-continue"
+            ) else None,
+            self.progress, self.pause
+        )
+
+        # "wsgi.input" is set up by ServerHandler from its "stdin"
+        handler = FUPServerHandler(
+            body, self.wfile, self.get_stderr(), env,
+            multithread=True
+        )
+        handler.request_handler = self
+        if self.request_version == "HTTP/1.1":
+            handler.http_version = "1.1"
+        else:
+            self.close_connection = True
+        # decision has to be made before response headers are sent
+        handler.finish_response = self.finishing(
+            handler.finish_response, body
+        )
+        try:
+            handler.run(self.server.get_app())
+        finally:
+            server.watchdog.disarm(self)
+            self.receiving = False
+
+
+    def handle_expect_100 (self):
+        """Don't send "100 Continue" while parsing request headers.
+
+        It's deferred until the application reads the body (see RequestBody),
+        so requests rejected upfront (401, 413, 503, ...) get their final
+        response instead and the body is never transferred.
+        """
+
+        return True
+
+
+    def send_continue (self):
+        """Send "100 Continue" interim response."""
+
+        self.wfile.write(utf8_encode("HTTP/1.1 100 Continue\r\n\r\n"))
+        self.wfile.flush()
+
+
+    def finishing (self, finish_response, body):
+        """Close connection if request body hasn't been fully consumed."""
+
+        def finish ():
+            if body.remaining > 0 and not body.drain(self.drain_limit):
+                self.close_connection = True
+            self.server.watchdog.disarm(self)
+            if self.evicted or self.server.draining:
+                self.close_connection = True
+            return finish_response()
+        return finish
+
+
+    def arm (self, timeout, reason):
+        """Set a deadline for the current phase of the connection."""
+
+        self.server.watchdog.arm(self, timeout, lambda: self.evict(reason))
+
+
+    def evict (self, reason, shutdown=True):
+        """Drop the connection (called by watchdog or on a too slow upload).
+
+        Without "shutdown" the connection is closed after the response.
+        """
+
+        self.evicted = reason
+        self.close_connection = True
+        total = self.server.watchdog.count(reason)
+        if reason != "idle connection":
+            self.server.stats.add("evicted")
+            print(
+                "%s - - [%s] evicted: \"%s\" (%u evictions so far)" % (
+                    self.client_address[0],
+                    time.strftime("%d/%b/%Y %H:%M:%S"),
+                    reason, total
+                ),
+                file=sys.stderr
+            )
+        if not shutdown:
+            return
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except (IOError, OSError, socket.error):
+            pass
+
+
+    def progress (self, count):
+        """Enforce minimum upload rate over a sliding window."""
+
+        if self.evicted:
+            raise SlowClient(self.evicted)
+        server = self.server
+        now = clock()
+        self.received += count
+        server.stats.add("received", count)
+        self.arm(server.rate_window, "upload stalled")
+        if not server.min_rate:
+            return
+        samples = self.samples
+        samples.append((now, self.received))
+        while len(samples) > 2 and samples[1][0] <= now - server.rate_window:
+            samples.popleft()
+        span = now - samples[0][0]
+        if span >= server.rate_window:
+            rate = (self.received - samples[0][1]) / span
+            if rate < server.min_rate:
+                server.watchdog.disarm(self)
+                self.evict("upload too slow (%u B/s)" % rate, False)
+                raise SlowClient("upload too slow")
+
+
+    def pause (self, seconds):
+        """Exclude time an upload is held back (shaped) from rate checks."""
+
+        self.samples = deque((t + seconds, n) for t, n in self.samples)
+        self.arm(self.server.rate_window + seconds, "upload stalled")
+
+
+    def log_request (self, code="-", size="-"):
+        """Count a response (see Stats) and log it."""
+
+        self.server.stats.response(code, size)
+        WSGIRequestHandler.log_request(self, code, size)
 
 
     def log_message (self, format, *args):
@@ -719,6 +4014,154 @@ class FUPRequestHandler(WSGIRequestHandler):
 
 
 
+# WSGIServer with ThreadingMixIn - each request is handled in a separate
+# thread, so concurrent uploads (e.g. from the client-side upload queue)
+# don't have to wait for each other.
+class FUPServer(ThreadingMixIn, WSGIServer):
+
+    """Multithreaded WSGI server."""
+
+    daemon_threads = True
+
+    # time allowed for sending request line and headers (in seconds)
+    header_timeout = 30
+
+    # time a persistent connection can wait for the next request
+    keepalive_timeout = 15
+
+    # minimum rate of receiving request bodies (in bytes/s, 0 - none)
+    # measured over a sliding window (of seconds), which is also
+    # the longest time a body can stall without any data coming in
+    min_rate = 0
+    rate_window = 30
+
+    # is the listening socket inherited (e.g. from systemd)?
+    inherited = False
+
+    # activity counters (shared with the main process)
+    stats = NullStats()
+
+
+    def __init__ (
+        self, server_address, RequestHandlerClass,
+        bind_and_activate=True, sock=None
+    ):
+        """Bind to an address or use already listening socket "sock".
+
+        Address can be a (host, port) pair or a path of a unix domain socket.
+        """
+
+        self.active = set()
+        self.changed = Condition()
+        self.draining = False
+        if sock is None:
+            if not isinstance(server_address, tuple):
+                self.address_family = socket.AF_UNIX
+            WSGIServer.__init__(
+                self, server_address, RequestHandlerClass, bind_and_activate
+            )
+            return
+        self.address_family = sock.family
+        WSGIServer.__init__(self, server_address, RequestHandlerClass, False)
+        self.socket.close()
+        self.socket = sock
+        self.server_address = sock.getsockname()
+        self.inherited = True
+        self.name()
+        self.setup_environ()
+        if bind_and_activate:
+            self.server_activate()
+
+
+    def server_bind (self):
+        """Bind to an address (replacing stale unix domain socket file)."""
+
+        if self.address_family != getattr(socket, "AF_UNIX", None):
+            return WSGIServer.server_bind(self)
+        import stat
+        try:
+            if stat.S_ISSOCK(os.stat(self.server_address).st_mode):
+                os.remove(self.server_address)
+        except OSError:
+            pass
+        self.socket.bind(self.server_address)
+        self.name()
+        self.setup_environ()
+
+
+    def name (self):
+        """Set SERVER_NAME and SERVER_PORT sources."""
+
+        if isinstance(self.server_address, tuple):
+            host, port = self.server_address[:2]
+            self.server_name = socket.getfqdn(host)
+            self.server_port = port
+        else:
+            self.server_name = "localhost"
+            self.server_port = 0
+
+
+    def server_activate (self):
+        """Start listening and checking connection deadlines."""
+
+        if not self.inherited:
+            WSGIServer.server_activate(self)
+        self.watchdog = Watchdog()
+
+
+    def drain (self, timeout):
+        """Stop listening, let active connections finish (within timeout)."""
+
+        self.server_close()
+        with self.changed:
+            self.draining = True
+            idle = [handler for handler in self.active if handler.idle]
+            print(
+                "- - - [%s] draining %u connection(s)" % (
+                    time.strftime("%d/%b/%Y %H:%M:%S"),
+                    len(self.active) - len(idle)
+                ),
+                file=sys.stderr
+            )
+        for handler in idle:
+            handler.evict("idle connection")
+        deadline = clock() + timeout
+        with self.changed:
+            while self.active and clock() < deadline:
+                self.changed.wait(deadline - clock())
+            left = list(self.active)
+        for handler in left:
+            # uploads are dropped (and their partial files removed)
+            handler.evict("drain timeout")
+        with self.changed:
+            if self.active:
+                self.changed.wait(5)
+
+
+    def sample (self, period=0.5):
+        """Publish numbers of open connections and uploads in progress."""
+
+        while True:
+            handlers = list(self.active)
+            self.stats.set("open", len(handlers))
+            self.stats.set(
+                "uploads", sum(1 for handler in handlers if handler.receiving)
+            )
+            time.sleep(period)
+
+
+    def get_request (self):
+        """Accept a connection."""
+
+        conn, addr = self.socket.accept()
+        if not isinstance(addr, tuple):
+            # unix domain socket peers are anonymous
+            addr = ("unix", 0)
+        return conn, addr
+
+
+
+
 # Parse command-line arguments,
 # instantiate Application object
 # and run WSGI server.
@@ -729,6 +4172,7 @@ class Main(object):
     def __init__ (self):
         """Program entry point."""
 
+        import signal
         realhostip = "*"
         try:
             from socket import gethostbyname, gethostname
@@ -737,6 +4181,7 @@ class Main(object):
             pass
 
         args = self.parse_args()
+        self.unix = args.unix
         signal.signal(signal.SIGINT, self.exit)
         print(
             "[%s pyfup/%s]" % (
@@ -756,54 +4201,165 @@ class Main(object):
                 self.exit()
             if not os.path.isfile(args.cert):
                 print(
-                    "Provide a valid path to SSL certificate " +
-                    "file using --cert argument.",
+                    "Provide a valid path to SSL certificate " +
+                    "file using --cert argument.",
+                    file=sys.stderr
+                )
+                self.exit()
+        elif os.path.isfile(args.key) or os.path.isfile(args.cert):
+            print("Use --ssl switch.", file=sys.stderr)
+            self.exit()
+
+        if args.peer and not args.replicate_key:
+            print(
+                "Provide a key shared with peers using --replicate-key.",
+                file=sys.stderr
+            )
+            self.exit()
+
+        if args.post:
+            try:
+                __import__("concurrent.futures")
+            except ImportError:
+                print(
+                    "Post-processing (--post) requires concurrent.futures " +
+                    "(python 3.2+ or \"futures\" package).",
                     file=sys.stderr
                 )
                 self.exit()
-        elif os.path.isfile(args.key) or os.path.isfile(args.cert):
-            print("Use --ssl switch.", file=sys.stderr)
+
+        # systemd socket activation or a reload (see reload),
+        # first of passed sockets is used
+        listen_fd = None
+        if (
+            os.environ.get("LISTEN_PID") == str(os.getpid()) and
+            int(os.environ.get("LISTEN_FDS") or 0) > 0
+        ):
+            listen_fd = 3
+            for name in ("LISTEN_PID", "LISTEN_FDS", "LISTEN_FDNAMES"):
+                os.environ.pop(name, None)
+        # processes of a previous generation finishing their uploads
+        self.draining = [
+            int(pid) for pid in
+                os.environ.pop("PYFUP_DRAINING", "").split(",") if pid
+        ]
+        for pid in self.draining:
+            reaper = Thread(target=self.reap, args=(pid,))
+            reaper.daemon = True
+            reaper.start()
+
+        # listening socket is owned by this (main) process, so it can be
+        # handed over to new server processes on reload
+        try:
+            self.socket = self.listener(args.host, args.port, {
+                "unix" : self.unix, "listen_fd" : listen_fd
+            })
+        except (IOError, OSError):
+            print(
+                "Error: can't listen (%s)." % sys.exc_info()[1],
+                file=sys.stderr
+            )
             self.exit()
 
-        q = Queue()
+        # activity counters of the server (row 0) and sproxy (row 1)
+        self.stats = Stats(2)
+
         server_config = {
             "ppid" : os.getpid(),
+            "stats" : self.stats.row(0),
             "no_js" : args.no_js,
+            "parallel" : args.parallel,
             "auth" : args.auth,
             "ssl" : args.ssl,
             "key" : args.key,
-            "cert" : args.cert
+            "cert" : args.cert,
+            "profile" : args.profile,
+            "profile_dir" : args.profile_dir,
+            "upload_dir" : args.upload_dir,
+            "shard" : args.shard,
+            "spool_threshold" : args.spool_threshold,
+            "rate_client" : args.rate_client,
+            "rate_user" : args.rate_user,
+            "rate_total" : args.rate_total,
+            "max_uploads" : args.max_uploads,
+            "max_client_uploads" : args.max_client_uploads,
+            "upload_line" : args.upload_line,
+            "upload_wait" : args.upload_wait,
+            "post" : args.post,
+            "post_workers" : args.post_workers,
+            "post_journal" : args.post_journal,
+            "quarantine_dir" : args.quarantine_dir,
+            "peers" : args.peer,
+            "replicate_key" : args.replicate_key,
+            "replicate_rate" : args.replicate_rate,
+            "replicate_dir" : args.replicate_dir,
+            "replicate_insecure" : args.replicate_insecure,
+            "index" : args.index,
+            "delta" : args.delta,
+            "max_size" : args.max_size,
+            "header_timeout" : args.header_timeout,
+            "keepalive_timeout" : args.keepalive_timeout,
+            "min_rate" : args.min_rate,
+            "rate_window" : args.rate_window,
+            "drain_timeout" : args.drain_timeout
         }
 
         if args.ssl and args.use_sproxy:
+            inner = self.listener("127.0.0.1", 0, {})
             self.server_process = Process(
                 target=self.run_server,
-                args=(q, "127.0.0.1", 0, server_config)
+                args=("127.0.0.1", 0, dict(server_config, **{
+                    "listen_fd" : inner.fileno()
+                }))
             )
             self.server_process.start()
             self.proxy_process = Process(
                 target=self.run_sproxy,
                 args=(args.host, args.port, {
-                    "server_port" : q.get()
+                    "listen_fd" : self.socket.fileno(),
+                    "server_port" : inner.getsockname()[1],
+                    "header_timeout" : args.header_timeout,
+                    "drain_timeout" : args.drain_timeout,
+                    "stats" : self.stats.row(1)
                 })
             )
             self.proxy_process.start()
         else:
             self.server_process = Process(
                 target=self.run_server,
-                args=(q, args.host, args.port, server_config)
+                args=(args.host, args.port, dict(server_config, **{
+                    "listen_fd" : self.socket.fileno()
+                }))
             )
             self.server_process.start()
+        signal.signal(signal.SIGTERM, self.stop)
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, self.reload)
 
         print(
-            "listening on %s:%u <%s:%u>%s%s" % (
-                args.host, args.port, realhostip, args.port,
+            "listening on %s%s%s" % (
+                "%s:%u <%s:%u>" % (
+                    args.host, args.port, realhostip, args.port
+                ) if listen_fd is None and self.unix is None
+                    else "unix:%s" % self.unix if self.unix is not None
+                    else "inherited socket",
                 " (SSL enabled)" if args.ssl else "",
                 " [through sproxy]" if args.ssl and args.use_sproxy else ""
             ),
             file=sys.stderr
         )
 
+        self.started = clock()
+        self.samples = deque([(self.started, self.stats.total())], maxlen=61)
+        watcher = Thread(target=self.watch, args=(
+            args.status if args.status is not None
+                else 10 if sys.stderr.isatty() else 0,
+        ))
+        watcher.daemon = True
+        watcher.start()
+        if sys.stdin.isatty():
+            print("(press Enter for status)", file=sys.stderr)
+
         self.main_loop()
 
 
@@ -843,6 +4399,208 @@ class Main(object):
                 "--no-js", action="store_true", default=False,
                 help="do not use JavaScript on client side"
             )
+            argparser.add_argument(
+                "-d", "--upload-dir", action="store", default=".",
+                type=str, metavar="DIR", help=dedent("""\
+                    directory to store uploaded files in \
+                    [default: current directory]"""
+                )
+            )
+            argparser.add_argument(
+                "--shard", action="store", default="none",
+                choices=Storage.layouts, help=dedent("""\
+                    spread uploaded files over subdirectories \
+                    by upload date (YYYY/MM/DD) or by a hash prefix \
+                    of their names (xx/yy) [default: none]"""
+                )
+            )
+            argparser.add_argument(
+                "--spool-threshold", action="store", default=1<<20,
+                type=int, metavar="BYTES", help=dedent("""\
+                    uploads up to that size are kept in memory and \
+                    written to disk at once, bigger ones go through \
+                    ".part" files [default: 1048576]"""
+                )
+            )
+            argparser.add_argument(
+                "--max-size", action="store", default=0, type=byte_size,
+                metavar="SIZE", help=dedent("""\
+                    reject uploads (requests) bigger than that \
+                    with "413 Payload Too Large", K/M/G suffixes \
+                    allowed [default: 0 (unlimited)]"""
+                )
+            )
+            argparser.add_argument(
+                "--header-timeout", action="store", default=30, type=float,
+                metavar="SECONDS", help=dedent("""\
+                    time allowed for sending request headers \
+                    [default: 30]"""
+                )
+            )
+            argparser.add_argument(
+                "--keepalive-timeout", action="store", default=15,
+                type=float, metavar="SECONDS", help=dedent("""\
+                    time an idle persistent connection is kept open \
+                    [default: 15]"""
+                )
+            )
+            argparser.add_argument(
+                "--min-rate", action="store", default=0, type=byte_size,
+                metavar="RATE", help=dedent("""\
+                    evict clients sending request bodies slower than \
+                    that (bytes/s) over --rate-window \
+                    [default: 0 (disabled)]"""
+                )
+            )
+            argparser.add_argument(
+                "--rate-window", action="store", default=30, type=float,
+                metavar="SECONDS", help=dedent("""\
+                    window of --min-rate measurement, also the longest \
+                    time a read of a request body can take [default: 30]"""
+                )
+            )
+            argparser.add_argument(
+                "--drain-timeout", action="store", default=300, type=float,
+                metavar="SECONDS", help=dedent("""\
+                    time given to uploads in progress to finish \
+                    on reload (SIGHUP) or stop (SIGTERM) [default: 300]"""
+                )
+            )
+            argparser.add_argument(
+                "--rate-client", action="store", default=0, type=byte_size,
+                metavar="RATE", help=dedent("""\
+                    upload bandwidth limit per client address \
+                    in bytes/s, K/M/G suffixes allowed \
+                    [default: 0 (unlimited)]"""
+                )
+            )
+            argparser.add_argument(
+                "--rate-user", action="store", default=0, type=byte_size,
+                metavar="RATE", help=dedent("""\
+                    upload bandwidth limit per authenticated user \
+                    [default: 0 (unlimited)]"""
+                )
+            )
+            argparser.add_argument(
+                "--rate-total", action="store", default=0, type=byte_size,
+                metavar="RATE", help=dedent("""\
+                    total upload bandwidth limit, shared fairly \
+                    among clients (or users) [default: 0 (unlimited)]"""
+                )
+            )
+            argparser.add_argument(
+                "--max-uploads", action="store", default=0, type=int,
+                metavar="N", help=dedent("""\
+                    maximum number of concurrent uploads, others are \
+                    rejected with "503 Service Unavailable" \
+                    [default: 0 (unlimited)]"""
+                )
+            )
+            argparser.add_argument(
+                "--max-client-uploads", action="store", default=0,
+                type=int, metavar="N", help=dedent("""\
+                    maximum number of concurrent uploads per client \
+                    address [default: 0 (unlimited)]"""
+                )
+            )
+            argparser.add_argument(
+                "--upload-line", action="store", default=0, type=int,
+                metavar="N", help=dedent("""\
+                    number of uploads over the limits allowed to wait \
+                    for admission [default: 0]"""
+                )
+            )
+            argparser.add_argument(
+                "--upload-wait", action="store", default=5.0, type=float,
+                metavar="SECONDS", help=dedent("""\
+                    maximum time of waiting for admission [default: 5]"""
+                )
+            )
+            argparser.add_argument(
+                "--post", action="append", default=[], type=str,
+                metavar="STEP", help=dedent("""\
+                    post-process uploaded files in background, \
+                    STEP is one of: sha256, gzip, zstd, quarantine \
+                    or module:function (can be given multiple times)"""
+                )
+            )
+            argparser.add_argument(
+                "--post-workers", action="store", default=2, type=int,
+                metavar="N", help=dedent("""\
+                    number of post-processing worker processes \
+                    [default: 2]"""
+                )
+            )
+            argparser.add_argument(
+                "--post-journal", action="store",
+                default="pyfup-post.journal", type=str, metavar="FILE",
+                help=dedent("""\
+                    file keeping post-processing jobs across restarts \
+                    [default: pyfup-post.journal]"""
+                )
+            )
+            argparser.add_argument(
+                "--quarantine-dir", action="store", default="quarantine",
+                type=str, metavar="DIR", help=dedent("""\
+                    target directory of "quarantine" post-processing \
+                    step [default: quarantine]"""
+                )
+            )
+            argparser.add_argument(
+                "--peer", action="append", default=[], type=str,
+                metavar="URL", help=dedent("""\
+                    replicate uploaded files to another pyfup node \
+                    (can be given multiple times)"""
+                )
+            )
+            argparser.add_argument(
+                "--replicate-key", action="store", default=None, type=str,
+                metavar="KEY", help=dedent("""\
+                    key shared with peers, used to sign replication \
+                    requests (also enables receiving replicated files)"""
+                )
+            )
+            argparser.add_argument(
+                "--replicate-rate", action="store", default=0,
+                type=byte_size, metavar="RATE", help=dedent("""\
+                    total replication bandwidth limit in bytes/s \
+                    [default: 0 (unlimited)]"""
+                )
+            )
+            argparser.add_argument(
+                "--replicate-dir", action="store", default="pyfup-replica",
+                type=str, metavar="DIR", help=dedent("""\
+                    directory of files waiting for replication \
+                    [default: pyfup-replica]"""
+                )
+            )
+            argparser.add_argument(
+                "--replicate-insecure", action="store_true",
+                default=False, help=dedent("""\
+                    do not verify SSL certificates of https:// peers"""
+                )
+            )
+            argparser.add_argument(
+                "--index", action="store", default=None, type=str,
+                metavar="FILE", help=dedent("""\
+                    record uploads in an SQLite database, queryable \
+                    at /uploads [default: disabled]"""
+                )
+            )
+            argparser.add_argument(
+                "--delta", action="store_true", default=False,
+                help=dedent("""\
+                    let clients update stored files by sending only their \
+                    changed blocks (serves /signature and /delta)"""
+                )
+            )
+            argparser.add_argument(
+                "--parallel", action="store", default=4, type=int,
+                metavar="N", help=dedent("""\
+                    number of concurrent uploads performed by client-side \
+                    upload queue [default: 4]"""
+                )
+            )
             argparser.add_argument(
                 "--use-sproxy", action="store_true", default=False,
                 help=dedent("""\
@@ -854,6 +4612,35 @@ class Main(object):
                 "--host", action="store", default="0.0.0.0",
                 type=str, help="specify host [default: 0.0.0.0]"
             )
+            argparser.add_argument(
+                "--unix", action="store", default=None, type=str,
+                metavar="PATH", help=dedent("""\
+                    listen on a unix domain socket instead of TCP \
+                    (sockets passed by systemd are used automatically)"""
+                )
+            )
+            argparser.add_argument(
+                "--status", action="store", default=None, type=float,
+                metavar="SECONDS", help=dedent("""\
+                    print a status line (uploads, connections, transfer \
+                    and error rates) that often, 0 disables it \
+                    [default: 10 on a terminal, 0 otherwise]"""
+                )
+            )
+            argparser.add_argument(
+                "--profile", action="store", default=0, type=int,
+                metavar="N", help=dedent("""\
+                    profile one request in N with cProfile/tracemalloc \
+                    and send Server-Timing headers [default: 0 (disabled)]"""
+                )
+            )
+            argparser.add_argument(
+                "--profile-dir", action="store", default="pyfup-profile",
+                type=str, metavar="DIR", help=dedent("""\
+                    directory for profile dumps \
+                    [default: pyfup-profile]"""
+                )
+            )
             argparser.add_argument(
                 "port", action="store", default=8000, type=int,
                 nargs="?", help="specify alternate port [default: 8000]"
@@ -863,12 +4650,44 @@ class Main(object):
             class ArgsStub:
                 host = "0.0.0.0"
                 port = 8000
+                unix = None
                 no_js = False
+                parallel = 4
+                upload_dir = "."
+                shard = "none"
+                spool_threshold = 1<<20
+                max_size = 0
+                header_timeout = 30
+                keepalive_timeout = 15
+                min_rate = 0
+                rate_window = 30
+                drain_timeout = 300
+                status = None
+                rate_client = 0
+                rate_user = 0
+                rate_total = 0
+                max_uploads = 0
+                max_client_uploads = 0
+                upload_line = 0
+                upload_wait = 5.0
+                post = []
+                post_workers = 2
+                post_journal = "pyfup-post.journal"
+                quarantine_dir = "quarantine"
+                peer = []
+                replicate_key = None
+                replicate_rate = 0
+                replicate_dir = "pyfup-replica"
+                replicate_insecure = False
+                index = None
+                delta = False
                 use_sproxy = False
                 auth = "__NO_AUTH__"
                 ssl = False
                 key = "__NO_KEY__"
                 cert = "__NO_CERT__"
+                profile = 0
+                profile_dir = "pyfup-profile"
             return ArgsStub()
 
 
@@ -879,17 +4698,98 @@ class Main(object):
             self.proxy_process.terminate()
         if hasattr(self, "server_process"):
             self.server_process.terminate()
+        if (
+            getattr(self, "unix", None) is not None and
+            os.path.exists(self.unix)
+        ):
+            os.remove(self.unix)
         print("\nBye!", file=sys.stderr)
         sys.exit()
 
 
-    def run_server (self, q, host, port, config):
+    def stop (self, sig_num=None, stack_frame=None):
+        """SIGTERM handler: let uploads in progress finish, then exit."""
+
+        import signal
+        print("\nFinishing uploads in progress...", file=sys.stderr)
+        processes = [
+            p for p in (
+                getattr(self, "server_process", None),
+                getattr(self, "proxy_process", None)
+            ) if p is not None
+        ]
+        for p in processes:
+            os.kill(p.pid, signal.SIGTERM)
+        for p in processes:
+            p.join()
+        self.exit()
+
+
+    def reload (self, sig_num=None, stack_frame=None):
+        """SIGHUP handler: zero-downtime restart.
+
+        Current server processes stop accepting connections and finish
+        uploads in progress (within --drain-timeout), while the program
+        is executed anew (picking up new code, certificates, ...) and
+        starts new processes on the same listening socket. Connections
+        arriving in the meantime wait in the socket's backlog. Queued
+        replication and post-processing is taken over by new processes
+        once the old ones exit (see take_over).
+        """
+
+        import signal
+        old = [
+            p.pid for p in (
+                getattr(self, "server_process", None),
+                getattr(self, "proxy_process", None)
+            ) if p is not None
+        ]
+        for pid in old:
+            os.kill(pid, signal.SIGTERM)
+        # hand the socket over the same way systemd does
+        os.dup2(self.socket.fileno(), 3)
+        if hasattr(os, "set_inheritable"):
+            os.set_inheritable(3, True)
+        os.environ["LISTEN_PID"] = str(os.getpid())
+        os.environ["LISTEN_FDS"] = "1"
+        os.environ["PYFUP_DRAINING"] = ",".join(
+            str(pid) for pid in self.draining + old
+        )
+        print("\nReloading...", file=sys.stderr)
+        sys.stderr.flush()
+        os.execv(sys.executable, [sys.executable] + [
+            "-W" + w for w in sys.warnoptions
+        ] + sys.argv)
+
+
+    def reap (self, pid):
+        """Wait for a process of a previous generation to finish."""
+
+        try:
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+        self.draining.remove(pid)
+
+
+    def run_server (self, host, port, config):
         """WSGIServer config and main loop."""
 
-        httpd = make_server(
-            host, port, Application(config),
-            handler_class=FUPRequestHandler
+        import signal
+        httpd = FUPServer(
+            None, FUPRequestHandler, sock=self.listener(host, port, config)
         )
+        app = Application(config)
+        httpd.set_app(app)
+        httpd.header_timeout = config["header_timeout"]
+        httpd.keepalive_timeout = config["keepalive_timeout"]
+        httpd.min_rate = config["min_rate"]
+        httpd.rate_window = config["rate_window"]
+        if config.get("stats") is not None:
+            httpd.stats = config["stats"]
+            sampler = Thread(target=httpd.sample)
+            sampler.daemon = True
+            sampler.start()
 
         if config["ssl"]:
             try:
@@ -899,7 +4799,10 @@ class Main(object):
                     keyfile=config["key"],
                     certfile=config["cert"],
                     cert_reqs=ssl.CERT_NONE,
-                    server_side=True
+                    server_side=True,
+                    # handshake in a request handler thread (under
+                    # header deadline), not in the accepting one
+                    do_handshake_on_connect=False
                 )
             except ImportError:
                 print(
@@ -916,8 +4819,16 @@ class Main(object):
                 )
                 os.kill(config["ppid"], signal.SIGINT)
                 return
-        q.put(httpd.server_port)
+
+        def drain (sig_num, stack_frame):
+            # serve_forever can't be stopped from its own thread
+            Thread(target=httpd.shutdown).start()
+        signal.signal(signal.SIGTERM, drain)
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
         httpd.serve_forever()
+        httpd.drain(config["drain_timeout"])
+        app.close()
 
 
     def run_sproxy (self, host, port, config):
@@ -927,6 +4838,8 @@ class Main(object):
             "OPTIONS", "GET", "HEAD", "POST",
             "PUT", "DELETE", "TRACE", "CONNECT"
         ]
+        # relayed requests are counted by the server
+        stats = config.get("stats") or NullStats()
 
         def quiet (fun, *args):
             try:
@@ -971,9 +4884,14 @@ class Main(object):
         def request_handler (client_connection, addr):
             server_connection = None
             server_handler_thread = None
+            # the server enforces deadlines once the connection is relayed,
+            # but a client has to start talking in time
+            client_connection.settimeout(config["header_timeout"])
             while True:
                 try:
                     data = client_connection.recv(2**10)
+                    if server_connection is None:
+                        client_connection.settimeout(None)
                     if data:
                         if not server_connection and True in (
                             sv for sv in map(
@@ -990,6 +4908,7 @@ class Main(object):
                                 client_connection.sendall(
                                     utf8_encode(redirect(match.group(1)))
                                 )
+                                stats.response(307, 10)
                                 print(
                                     (
                                         "%s - - [%s] sproxy: " +
@@ -1004,6 +4923,7 @@ class Main(object):
                                 client_connection.sendall(
                                     utf8_encode(bad_request())
                                 )
+                                stats.response(400, 12)
                                 print(
                                     (
                                         "%s - - [%s] sproxy: " +
@@ -1039,6 +4959,15 @@ class Main(object):
                             server_connection.sendall(data)
                     else:
                         break
+                except socket.timeout:
+                    print(
+                        "%s - - [%s] sproxy: evicted: \"%s\"" % (
+                            addr[0], time.strftime("%d/%b/%Y %H:%M:%S"),
+                            "request headers timeout"
+                        ),
+                        file=sys.stderr
+                    )
+                    break
                 except:
                     break
             if server_handler_thread:
@@ -1049,11 +4978,31 @@ class Main(object):
                 server_connection = None
             client_connection.close()
 
-        sproxy = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sproxy.bind((host, port))
-        sproxy.listen(5)
+        import signal
+        sproxy = self.listener(host, port, config)
+
+        def drain (sig_num, stack_frame):
+            # stop accepting, relayed connections have a deadline to finish
+            # (the process ends when the last relaying thread does)
+            quiet(sproxy.close)
+            deadline = Thread(
+                target=lambda: (
+                    time.sleep(config["drain_timeout"]), os._exit(0)
+                )
+            )
+            deadline.daemon = True
+            deadline.start()
+        signal.signal(signal.SIGTERM, drain)
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
         while True:
-            client_connection, addr = sproxy.accept()
+            try:
+                client_connection, addr = sproxy.accept()
+            except (IOError, OSError, socket.error):
+                break
+            if not isinstance(addr, tuple):
+                addr = ("unix", 0)
             print(
                 "%s - - - sproxy: \"connection\"" % (addr[0]),
                 file=sys.stderr
@@ -1064,21 +5013,621 @@ class Main(object):
             ).start()
 
 
-    def main_loop (self):
-        """Main process loop (just to keep it alive)."""
+    @staticmethod
+    def listener (host, port, config):
+        """Listening socket: inherited (from systemd), unix domain or TCP."""
+
+        fd = config.get("listen_fd")
+        if fd is not None:
+            try:
+                return socket.socket(fileno=fd)
+            except TypeError:
+                # python 2.x can't detect family of a socket
+                return socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+        if config.get("unix") is not None:
+            import stat
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                if stat.S_ISSOCK(os.stat(config["unix"]).st_mode):
+                    os.remove(config["unix"])
+            except OSError:
+                pass
+            sock.bind(config["unix"])
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((host, port))
+        # room for connections arriving while server processes restart
+        sock.listen(128)
+        return sock
+
+
+    def watch (self, interval):
+        """Sample shared counters every second.
+
+        Every "interval" seconds a status line is printed, unless
+        the server has been idle since the previous one.
+        """
+
+        printed = clock()
+        quiet = False
+        while True:
+            time.sleep(1.0)
+            self.samples.append((clock(), self.stats.total()))
+            if not interval or clock() - printed < interval:
+                continue
+            printed = clock()
+            values, rates = self.rates(interval)
+            busy = (
+                values["open"] or values["uploads"] or
+                rates["requests"] or rates["received"]
+            )
+            if busy or not quiet:
+                print(
+                    "- - - [%s] status: %s" % (
+                        time.strftime("%d/%b/%Y %H:%M:%S"),
+                        self.summary(values, rates)
+                    ),
+                    file=sys.stderr
+                )
+            quiet = not busy
+
+
+    def rates (self, window):
+        """Current values and per-second rates (over "window" seconds)."""
+
+        now, values = self.samples[-1]
+        then, previous = self.samples[0]
+        for then, previous in self.samples:
+            if then >= now - window - 0.5:
+                break
+        span = max(now - then, 1.0)
+        return values, dict(
+            (f, (values[f] - previous[f]) / span) for f in Stats.counters
+        )
+
 
+    @staticmethod
+    def summary (values, rates):
+        """One-line status."""
+
+        return (
+            "%u upload(s), %u connection(s), %.2f MB/s in, " +
+            "%.2f MB/s out, %.1f req/s, %.1f%% errors"
+        ) % (
+            values["uploads"], values["open"],
+            rates["received"] / 1048576.0, rates["sent"] / 1048576.0,
+            rates["requests"],
+            100.0 * (rates["errors_4xx"] + rates["errors_5xx"]) /
+                rates["requests"] if rates["requests"] else 0.0
+        )
+
+
+    def panel (self, window=10):
+        """Multi-line status (printed on demand)."""
+
+        values, rates = self.rates(window)
+        uptime = int(clock() - self.started)
+        requests = values["requests"] or 1
+        template = dedent("""\
+            --- pyfup status (up %u:%02u:%02u, rates over %us) ---
+            uploads in progress  %10u  %10.2f MB/s received
+            open connections     %10u  %10.2f MB/s sent
+            connections          %10u  %10u evicted
+            requests             %10u  %10.1f req/s
+            client errors (4xx)  %10u  %10.1f%%
+            server errors (5xx)  %10u  %10.1f%%
+            received / sent      %10.2f MB / %.2f MB""")
+        print(template % (
+            uptime // 3600, uptime // 60 % 60, uptime % 60, window,
+            values["uploads"], rates["received"] / 1048576.0,
+            values["open"], rates["sent"] / 1048576.0,
+            values["connections"], values["evicted"],
+            values["requests"], rates["requests"],
+            values["errors_4xx"], 100.0 * values["errors_4xx"] / requests,
+            values["errors_5xx"], 100.0 * values["errors_5xx"] / requests,
+            values["received"] / 1048576.0, values["sent"] / 1048576.0
+        ), file=sys.stderr)
+
+
+    def main_loop (self):
+        """Main process loop (shows status on Enter)."""
+
+        if not sys.stdin.isatty():
+            # no console (e.g. a service, stdin is /dev/null) - run as long
+            # as server processes do (signal handlers end them)
+            processes = [
+                p for p in (
+                    getattr(self, "server_process", None),
+                    getattr(self, "proxy_process", None)
+                ) if p is not None
+            ]
+            while processes:
+                processes[0].join(1)
+                processes = [p for p in processes if p.is_alive()]
+            self.exit()
         try:
             while True:
                 input()
+                self.panel()
         except EOFError:
             self.exit()
 
 
 
 
+# Command-line upload client ("fup.py send <url> <paths...>"):
+# stream multipart/form-data request bodies straight from disk
+# in fixed-size chunks over a few persistent connections.
+class Client(object):
+
+    """Upload client."""
+
+    # size of a chunk of file read from disk and sent at once
+    chunk_size = 1<<16
+
+    # number of attempts made for each file
+    attempts = 3
+
+    # time to wait for "100 Continue" before sending a request body anyway
+    # (longer than the server keeps uploads waiting for admission)
+    continue_timeout = 30
+
+
+    def __init__ (self, argv):
+        """Client entry point."""
+
+        try:
+            from urllib.parse import urlsplit, unquote
+        except ImportError:
+            from urlparse import urlsplit
+            from urllib import unquote
+        try:
+            import queue
+        except ImportError:
+            import Queue as queue
+        args = self.parse_args(argv)
+        url = urlsplit(args.url if "://" in args.url else "http://" + args.url)
+        self.ssl = args.ssl or url.scheme == "https"
+        self.insecure = args.insecure
+        self.host = url.hostname
+        self.port = url.port or (443 if self.ssl else 80)
+        self.path = url.path.rstrip("/")
+        if not self.path.endswith("/upload"):
+            self.path += "/upload"
+        self.auth = args.auth
+        if self.auth is None and url.username is not None:
+            self.auth = "%s:%s" % (
+                unquote(url.username), unquote(url.password or "")
+            )
+
+        # each job is a list of (path, size) sent in one request
+        self.jobs = queue.Queue()
+        self.empty = queue.Empty
+        self.tar = args.tar
+        self.delta = args.delta
+        self.lock = Lock()
+        self.sent = 0
+        self.done = 0
+        self.failed = 0
+        count = 0
+        batch = []
+        for path in args.paths:
+            for fn, size in self.walk(path):
+                batch.append((fn, size))
+                if not self.tar or len(batch) >= args.tar_batch:
+                    self.jobs.put(batch)
+                    batch = []
+                    count += 1
+        if batch:
+            self.jobs.put(batch)
+            count += 1
+
+        start = clock()
+        workers = [
+            Thread(target=self.worker)
+                for _ in range(max(1, min(args.jobs, count)))
+        ]
+        for w in workers:
+            w.daemon = True
+            w.start()
+        try:
+            for w in workers:
+                while w.is_alive():
+                    w.join(0.5)
+        except KeyboardInterrupt:
+            print("\nInterrupted.", file=sys.stderr)
+            sys.exit(1)
+        elapsed = clock() - start
+
+        print(
+            "%u file(s), %.2f MB in %.2fs (%.2f MB/s)%s" % (
+                self.done, self.sent / 1048576.0, elapsed,
+                self.sent / 1048576.0 / elapsed if elapsed > 0 else 0,
+                ", %u failed" % self.failed if self.failed else ""
+            ),
+            file=sys.stderr
+        )
+        sys.exit(1 if self.failed else 0)
+
+
+    def parse_args (self, argv):
+        """Command-line argument parser."""
+
+        from argparse import ArgumentParser
+        argparser = ArgumentParser(
+            prog="fup.py send",
+            description="Upload files to a pyfup server.",
+            epilog="More at: https://github.com/drmats/pyfup"
+        )
+        argparser.add_argument(
+            "--ssl", action="store_true", default=False,
+            help="use SSL (implied by https:// url)"
+        )
+        argparser.add_argument(
+            "--insecure", action="store_true", default=False,
+            help="do not verify server's SSL certificate"
+        )
+        argparser.add_argument(
+            "-a", "--auth", action="store", default=None,
+            type=str, help="specify username:password"
+        )
+        argparser.add_argument(
+            "-j", "--jobs", action="store", default=4, type=int,
+            metavar="N", help="number of concurrent uploads [default: 4]"
+        )
+        argparser.add_argument(
+            "--tar", action="store_true", default=False,
+            help="send files in batches, each as a single tar stream"
+        )
+        argparser.add_argument(
+            "--tar-batch", action="store", default=1000, type=int,
+            metavar="N", help="number of files in a tar batch [default: 1000]"
+        )
+        argparser.add_argument(
+            "--delta", action="store_true", default=False,
+            help=(
+                "update files already on the server by sending only "
+                "their changed blocks (server needs --delta)"
+            )
+        )
+        argparser.add_argument(
+            "url", action="store", type=str,
+            help="server address (e.g. http://host:8000/)"
+        )
+        argparser.add_argument(
+            "paths", action="store", nargs="+", type=str,
+            help="files or directories to upload"
+        )
+        args = argparser.parse_args(argv)
+        if args.tar and args.delta:
+            argparser.error("--tar and --delta can't be used together")
+        return args
+
+
+    def walk (self, path):
+        """Generate (path, size) of a file or all files under a directory."""
+
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for fn in sorted(files):
+                    fn = os.path.join(root, fn)
+                    if os.path.isfile(fn):
+                        yield fn, os.path.getsize(fn)
+        elif os.path.isfile(path):
+            yield path, os.path.getsize(path)
+        else:
+            print("%s: no such file or directory" % path, file=sys.stderr)
+            self.failed += 1
+
+
+    def connect (self):
+        """Create (lazily connecting) HTTP(S) connection to the server."""
+
+        try:
+            from http.client import HTTPConnection, HTTPSConnection
+        except ImportError:
+            from httplib import HTTPConnection, HTTPSConnection
+        if self.ssl:
+            import ssl
+            if self.insecure:
+                context = ssl._create_unverified_context()
+            else:
+                context = ssl.create_default_context()
+            return HTTPSConnection(self.host, self.port, context=context)
+        return HTTPConnection(self.host, self.port)
+
+
+    def worker (self):
+        """Upload files from the queue using one persistent connection."""
+
+        import tarfile
+        try:
+            from http.client import HTTPException
+        except ImportError:
+            from httplib import HTTPException
+        conn = self.connect()
+        send = (
+            self.upload_tar if self.tar else
+            self.upload_delta if self.delta else self.upload
+        )
+        while True:
+            try:
+                job = self.jobs.get_nowait()
+            except self.empty:
+                break
+            size = sum(s for _, s in job)
+            label = (
+                job[0][0] if not self.tar
+                    else "%s (+%u more, tar)" % (job[0][0], len(job) - 1)
+            )
+            attempt = 0
+            while True:
+                start = clock()
+                try:
+                    response = send(conn, job)
+                    status, reason = response.status, response.reason
+                except (
+                    IOError, OSError, socket.error, HTTPException,
+                    tarfile.TarError, ValueError
+                ):
+                    # stale keep-alive connection, refused connection,
+                    # malformed response, invalid delta signature, ...
+                    conn.close()
+                    e = sys.exc_info()[1]
+                    status, reason = 0, str(e)
+                    response = None
+                delay = self.retry_after(response)
+                if delay is not None:
+                    # admission control - wait as long as asked to
+                    # (doesn't count as a failed attempt)
+                    time.sleep(delay)
+                    continue
+                attempt += 1
+                if (
+                    (status == 0 or status >= 500) and
+                    attempt < self.attempts
+                ):
+                    time.sleep(2**(attempt - 1))
+                    continue
+                break
+            elapsed = clock() - start
+            # only a delta of the file may have been sent
+            sent = getattr(response, "pyfup_sent", size)
+            with self.lock:
+                if 200 <= status < 300:
+                    self.done += len(job)
+                    self.sent += sent
+                    print(
+                        "%s: %s %s [%.2f kB, %.2f MB/s]" % (
+                            label, status, reason, sent / 1024.0,
+                            sent / 1048576.0 / elapsed if elapsed > 0 else 0
+                        ),
+                        file=sys.stderr
+                    )
+                else:
+                    self.failed += len(job)
+                    print(
+                        "%s: failed - %s %s" % (label, status or "", reason),
+                        file=sys.stderr
+                    )
+        conn.close()
+
+
+    def request (self, conn, content_type, length, path=None, method="POST"):
+        """Send headers of an upload (or any other) request.
+
+        Request bodies are announced with "Expect: 100-continue". If the
+        server answers with a final response (e.g. "503" of admission
+        control) instead, the body must not be sent - the response
+        is returned (otherwise None).
+        """
+
+        conn.putrequest(method, path or self.path)
+        if content_type is not None:
+            conn.putheader("Content-Type", content_type)
+            conn.putheader("Content-Length", str(length))
+            conn.putheader("Expect", "100-continue")
+        if self.auth is not None:
+            conn.putheader("Authorization", "Basic " + codecs.decode(
+                base64.b64encode(utf8_encode(self.auth)), "ascii"
+            ))
+        conn.endheaders()
+        if content_type is not None:
+            return self.interim(conn)
+        return None
+
+
+    def interim (self, conn):
+        """Wait for "100 Continue" (return None) or a final response."""
+
+        sock = conn.sock
+        if not select.select([sock], [], [], self.continue_timeout)[0]:
+            # server ignoring the expectation
+            return None
+        # read byte by byte, so nothing of what follows is consumed
+        head = b""
+        while not head.endswith(b"\r\n\r\n"):
+            c = sock.recv(1)
+            if not c:
+                raise IOError("connection closed by server")
+            head += c
+        if head.split(None, 2)[1:2] == [b"100"]:
+            return None
+
+        match = re.search(br"\r\ncontent-length:[ \t]*(\d+)", head, re.I)
+        body = b""
+        left = int(match.group(1)) if match else 0
+        while len(body) < left:
+            chunk = sock.recv(left - len(body))
+            if not chunk:
+                break
+            body += chunk
+
+        class Replay(object):
+            def makefile (self, *args, **kwargs):
+                return BytesIO(head + body)
+
+        response = conn.response_class(Replay(), method="POST")
+        response.begin()
+        response.read()
+        # body of the request hasn't been sent - the connection is unusable
+        conn.close()
+        return response
+
+
+    def upload (self, conn, job):
+        """Stream one file as a multipart/form-data request body."""
+
+        fn, size = job[0]
+        boundary = "pyfup-" + codecs.decode(
+            binascii.hexlify(os.urandom(12)), "ascii"
+        )
+        name = os.path.basename(fn).replace("\\", "\\\\").replace(
+            "\"", "\\\""
+        )
+        head = utf8_encode(
+            "--%s\r\n" % boundary +
+            "Content-Disposition: form-data; " +
+            "name=\"file\"; filename=\"%s\"\r\n" % name +
+            "Content-Type: application/octet-stream\r\n\r\n"
+        )
+        tail = utf8_encode("\r\n--%s--\r\n" % boundary)
+
+        response = self.request(
+            conn, "multipart/form-data; boundary=" + boundary,
+            len(head) + size + len(tail)
+        )
+        if response is not None:
+            return response
+        conn.send(head)
+        left = size
+        with open(fn, "rb") as f:
+            while left > 0:
+                chunk = f.read(min(self.chunk_size, left))
+                if not chunk:
+                    raise IOError("file has shrunk during upload")
+                conn.send(chunk)
+                left -= len(chunk)
+        conn.send(tail)
+        response = conn.getresponse()
+        response.read()
+        return response
+
+
+    def upload_tar (self, conn, job):
+        """Stream a batch of files as a single (uncompressed) tar body."""
+
+        import tarfile
+        members = []
+        length = 0
+        for fn, size in job:
+            ti = tarfile.TarInfo(os.path.basename(fn))
+            ti.size = size
+            ti.mtime = int(os.path.getmtime(fn))
+            ti.mode = 0o644
+            # header(s) and data padded to full blocks
+            length += len(
+                ti.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+            )
+            length += -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            members.append((fn, ti))
+        # end-of-archive marker, archive padded to full records
+        length += 2 * tarfile.BLOCKSIZE
+        length = -(-length // tarfile.RECORDSIZE) * tarfile.RECORDSIZE
+
+        response = self.request(conn, "application/x-tar", length)
+        if response is not None:
+            return response
+
+        class Sink(object):
+            write = staticmethod(conn.send)
+
+        archive = tarfile.open(
+            fileobj=Sink(), mode="w|", format=tarfile.PAX_FORMAT,
+            encoding="utf-8", bufsize=self.chunk_size
+        )
+        for fn, ti in members:
+            with open(fn, "rb") as f:
+                archive.addfile(ti, f)
+        archive.close()
+        response = conn.getresponse()
+        response.read()
+        return response
+
+
+    def upload_delta (self, conn, job):
+        """Send only blocks of a file missing in its copy on the server.
+
+        Files the server doesn't have yet are uploaded as a whole.
+        Size of the delta is returned in "pyfup_sent" of the response.
+        """
+
+        try:
+            from urllib.parse import quote
+        except ImportError:
+            from urllib import quote
+        fn, size = job[0]
+        base = self.path[:-len("/upload")]
+        query = "?name=" + quote(utf8_encode(os.path.basename(fn)), safe="")
+        self.request(conn, None, 0, base + "/signature" + query, "GET")
+        response = conn.getresponse()
+        signature = response.read()
+        if response.status == 404 and response.getheader("X-Pyfup-Path"):
+            return self.upload(conn, job)
+        if response.status != 200:
+            return response
+
+        block, ops, digest = Delta.encode(fn, signature)
+        length = Delta.length(ops)
+        response = self.request(
+            conn, "application/x-pyfup-delta", length,
+            base + "/delta" + query
+        )
+        if response is not None:
+            return response
+        Delta.write(fn, block, ops, digest, conn.send, self.chunk_size)
+        response = conn.getresponse()
+        response.read()
+        response.pyfup_sent = length
+        with self.lock:
+            print(
+                "%s: delta of %.2f kB sent (%u%% of the file)" % (
+                    fn, length / 1024.0, 100 * length // max(size, 1)
+                ),
+                file=sys.stderr
+            )
+        return response
+
+
+    @staticmethod
+    def retry_after (response):
+        """Delay requested by a "503"/"429" response (or None)."""
+
+        if response is None or response.status not in (429, 503):
+            return None
+        value = response.getheader("Retry-After")
+        if value is None:
+            return None
+        try:
+            return max(0, int(value))
+        except ValueError:
+            # HTTP-date
+            from email.utils import parsedate_tz, mktime_tz
+            date = parsedate_tz(value)
+            if date is None:
+                return None
+            return max(0, mktime_tz(date) - time.time())
+
+
+
+
 # ...
 if __name__ == "__main__":
-    from multiprocessing import Process, Queue
-    Main()
+    if sys.argv[1:2] == ["send"]:
+        Client(sys.argv[2:])
+    else:
+        from multiprocessing import Process
+        Main()
 elif __name__ != "__parents_main__":
     app = Application()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+"""
+Import of fup.py has to stay cheap - it's done by every worker process
+(and by WSGI servers loading "fup:app").
+"""
+
+from __future__ import print_function, absolute_import
+
+import os
+import subprocess
+import sys
+import unittest
+
+from wsgiref.util import setup_testing_defaults
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import fup  # noqa: E402
+
+
+
+
+class ImportTest(unittest.TestCase):
+
+    """Modules loaded by "import fup"."""
+
+    # used only by some of code paths, imported where they're needed
+    lazy = (
+        "argparse", "concurrent.futures", "gzip", "hashlib", "json",
+        "mmap", "multiprocessing", "sqlite3", "tarfile", "zstandard"
+    )
+
+
+    def test_lazy_imports (self):
+        """Optional code paths don't load their modules on import."""
+
+        code = (
+            "import sys, fup; "
+            "print(' '.join(m for m in %r if m in sys.modules))"
+        ) % (self.lazy,)
+        out = subprocess.check_output(
+            [sys.executable, "-W", "ignore", "-c", code], cwd=ROOT
+        )
+        self.assertEqual(out.strip(), b"")
+
+
+
+
+class StaticPagesTest(unittest.TestCase):
+
+    """Static pages rendered on the first request."""
+
+    def request (self, app, path, **headers):
+        env = dict(("HTTP_" + k.upper(), v) for k, v in headers.items())
+        env["PATH_INFO"] = path
+        setup_testing_defaults(env)
+        response = {}
+
+        def start_response (status, headers):
+            response["status"] = status
+            response["headers"] = dict(headers)
+        response["body"] = b"".join(app(env, start_response))
+        return response
+
+
+    def test_pages (self):
+        """Pages are served plain and gzip-compressed."""
+
+        app = fup.Application()
+        for path in ("/", "/favicon.ico", "/m.css", "/m.js"):
+            plain = self.request(app, path)
+            self.assertEqual(plain["status"], "200 OK")
+            self.assertNotIn("Content-Encoding", plain["headers"])
+            gzipped = self.request(app, path, accept_encoding="gzip")
+            self.assertEqual(gzipped["headers"]["Content-Encoding"], "gzip")
+            self.assertEqual(
+                fup.GzipGlue.decompress(gzipped["body"]), plain["body"]
+            )
+
+
+
+
+if __name__ == "__main__":
+    unittest.main()